@@ -1,21 +1,49 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import queue
+import threading
 
 from common.utils import config, log, Status
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
 from elasticsearch_dsl import Search
 
+try:
+    import aiohttp
+    from elasticsearch import AsyncElasticsearch
+except ImportError:
+    aiohttp = None
+    AsyncElasticsearch = None
+
+BULK_CHUNK_SIZE = 500
+BULK_CHUNK_BYTES = 10*1024*1024
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
 
 class ElasticConnection:
     def __init__(self) -> None:
+        """
+        Clients (thread-safe, w/ their connection pool) are shared by all
+        instances connecting to the same host as the same user.
+        """
         self.client = None
         self.timeout = 120
         if config['elastic']:
             self.host = config['elastic']['url']
-            self.client = Elasticsearch(
-                hosts=[f'https://{self.host}:9243'],
-                http_auth=(config['elastic']['username'], config['elastic']['password']),
-                ssl_show_warn=False,
-                request_timeout=self.timeout, max_retries=10, retry_on_timeout=True)
+            key = (self.host, config['elastic']['username'])
+            with _clients_lock:
+                if key not in _clients:
+                    _clients[key] = Elasticsearch(
+                        hosts=[f'https://{self.host}:9243'],
+                        http_auth=(config['elastic']['username'],
+                                   config['elastic']['password']),
+                        ssl_show_warn=False,
+                        request_timeout=self.timeout, max_retries=10,
+                        retry_on_timeout=True)
+                self.client = _clients[key]
             # log.debug(self.client.cluster.health(request_timeout=self.timeout))
 
 
@@ -25,53 +53,119 @@ class ElasticCRUD(ElasticConnection):
         self.index = None
         if config['elastic']:
             self.index = config['elastic']['index'] if not index else index
-        self.s = Search(using=self.client)
 
-    def create(self):
-        ...
+    def create(self, doc=None, index=None, id_field=None, op_type='index',
+               chunk_size=None, max_chunk_bytes=None, workers=1,
+               max_retries=3) -> dict:
+        """
+        Index docs with the bulk API (streamed in chunks).
+        :param doc: doc, list of docs or iterable of docs (i.e. generator)
+        :param index: default: self.index
+        :param id_field: field used as _id (default: '_id' if present, or
+                         auto-generated)
+        :param op_type: 'index' (overwrite) or 'create' (i.e. data streams)
+        :param chunk_size: docs per bulk request (default: 500)
+        :param max_chunk_bytes: max bytes per bulk request (default: 10 MiB)
+        :param workers: number of parallel bulk requests (threads)
+        :param max_retries: retries (w/ exponential backoff) on 429 rejections
+        :return: response object, status.docs: docs indexed, status.failed and
+                 status.errors: per-doc errors (first 100)
+        """
+        return self._bulk(self._actions(doc, op_type, self._index(index), id_field),
+                          chunk_size, max_chunk_bytes, workers, max_retries)
+
+    def iter_read(self, where=None, collection=None, db=None, table=None,
+                  query=None, index=None, interval=None, sort=None,
+                  batch_size=1000, slices=None, keep_alive='1m', metadata=False):
+        """
+        Stream matching docs in batches, memory use is bound by batch_size.
+        Pages through a point-in-time (PIT) with search_after or, with slices,
+        runs a sliced scroll across as many threads (docs are not sorted).
+        :param where: {field: value} filters (see read())
+        :param index: index (or pattern), default: collection|table|db|self.index
+        :param interval: time range, see ts_range() (default: {'hour': 1})
+        :param sort: sort clauses (PIT only, default: ['_shard_doc'])
+        :param batch_size: docs per request/batch
+        :param slices: number of scroll slices (threads), None: PIT/search_after
+        :param keep_alive: PIT/scroll keep alive
+        :param metadata: add _meta object to every doc
+        :return: generator of [<dict>]
+        """
+        index = self._index(index, collection, table, db)
+        search = self._search(where, query, interval)
+        if slices:
+            yield from self._iter_sliced(search, index, slices, batch_size,
+                                         keep_alive, metadata)
+            return
+
+        pit = self.client.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+        try:
+            after = None
+            search = search.sort(*(self._sort(sort) if sort else ['_shard_doc'])) \
+                .extra(size=batch_size, track_total_hits=False)
+            while True:
+                body = search.extra(pit={'id': pit, 'keep_alive': keep_alive})
+                if after:
+                    body = body.extra(search_after=after)
+                res = self.client.search(body=body.to_dict())
+                pit = res.get('pit_id', pit)
+                hits = res['hits']['hits']
+                if not hits:
+                    break
+                yield [self._doc(hit, metadata) for hit in hits]
+                if len(hits) < batch_size:
+                    break
+                after = hits[-1]['sort']
+        finally:
+            self.client.close_point_in_time(id=pit)
 
     def read(self, where=None, collection=None, db=None, projection=None,
         sort=None, agg=None, select=None, table=None, groupby=None, like=None,
         query=None, index=None, limit=None, offset=None, interval=None,
-        metadata=False) -> dict:
+        metadata=False, track_total_hits=False) -> dict:
+        """
+        Read docs of index. Without limit/offset, all matching docs are
+        scanned, otherwise a single (size/from) request is sent.
+        :param projection: fields to return i.e. {'host': True, 'raw': False}
+                           (or list of fields)
+        :param select: list of fields to return (same as projection list)
+        :param sort: {field: 1|-1} (or list of ES sort clauses)
+        :param limit: max number of docs (size)
+        :param offset: number of docs to skip (from), size default: 1000
+        :param track_total_hits: True (or int: up to) to set status.hits on
+                                 limit/offset requests
+        :param agg: metrics {field: 'sum|avg|min|max|cardinality|count'} (or
+                    list of types), 'count' (default w/ groupby): doc count
+        :param groupby: field or list of fields (terms), {field: '5m'} for a
+                        date_histogram; buckets are paged (composite agg), limit
+                        caps the number of buckets returned
+        :return: response object (w/ agg or groupby, data: one row per bucket)
+        """
         r = []
         s = Status(404, 'No data found.')
         _s_type = 'match'
 
-        # -- build parameters
-        q = {}
-        if query is None:
-            if where:
-                # q[_s_type] = where
-                q = where
-        if isinstance(query, dict):
-            for k, v in query.items():
-                # q[_s_type].update({k: v})
-                q.update({k: v})
-        if index:
-            self.index = index
-        else:
-            if collection:
-                self.index = index = collection
-            elif table:
-                self.index = index = table
-            elif db:
-                self.index = index = db
-            else:
-                index = self.index
-        if interval is None:
-            interval = {'hour': 1}
+        # -- build request (new Search per call, self.index isn't changed)
+        index, search = self._request(where, collection, db, projection, sort,
+                                      select, table, query, index, interval)
 
         # -- fetch data
-        log.debug(f"Sending request: {q}")
-        self.s.query(_s_type, **q)
-        self.s.filter('range', **ts_range(interval=interval))
-        # data = self.s.index(index).execute()
-        data = self.s.index(index).scan()
+        log.debug(f"Sending request: {search.to_dict()}")
+        if agg or groupby:
+            s.table = index
+            s.kind = 'agg'
+            return self._response(self._aggregate(search, index, agg, groupby, limit), s)
+        if limit is None and offset is None:
+            data = (search.params(preserve_order=True) if sort else search).scan()
+        else:
+            offset = offset if offset else 0
+            res = search.extra(track_total_hits=track_total_hits)[
+                offset:offset + (limit if limit is not None else 1000)].execute()
+            data = res.hits
+            if track_total_hits:
+                s.hits = res.hits.total.to_dict()
         s.table = index
         s.kind = _s_type
-        # s.docs = self.s.count()
-        # s.hits = r.hits.total.to_dict()
 
         # -- build r(esult) object
         for hit in data:
@@ -86,15 +180,335 @@ class ElasticCRUD(ElasticConnection):
 
         return self._response(r, s)
 
-    def update(self):
-        ...
+    def read_many(self, requests, chunk_size=50) -> list:
+        """
+        Run many small reads in _msearch requests (chunk_size queries each),
+        i.e. same query w/ different where values.
+        :param requests: list of read() kwargs i.e. [{'where': {'host': 'r1'}}],
+                         limit default: 1000, agg/groupby requests are sent
+                         with read()
+        :param chunk_size: queries per _msearch request
+        :return: [<response object>] (same order as requests)
+        """
+        r = [None] * len(requests)
+        pending = []
+        for i, kw in enumerate(requests):
+            if kw.get('agg') or kw.get('groupby'):
+                r[i] = self.read(**kw)
+            else:
+                pending += [i]
+
+        for j in range(0, len(pending), chunk_size):
+            chunk = pending[j:j+chunk_size]
+            searches, indexes = self._msearch(requests, chunk)
+            try:
+                log.debug(f"read_many(): sending {len(chunk)} queries")
+                res = self.client.msearch(searches=searches)['responses']
+            except Exception as e:
+                log.error(f"read_many(): Server Error: {e}")
+                res = e
+            for i, d in zip(chunk, self._msearch_results(requests, chunk, indexes, res)):
+                r[i] = d
+        return r
 
-    def delete(self):
-        ...
+    def update(self, doc=None, index=None, id_field='_id', upsert=False,
+               chunk_size=None, max_chunk_bytes=None, workers=1,
+               max_retries=3) -> dict:
+        """
+        Partial update of docs (by id) with the bulk API, see create().
+        :param doc: doc(s) w/ id_field and fields to update
+        :param upsert: index doc if it doesn't exist
+        :return: response object
+        """
+        return self._bulk(self._actions(doc, 'update', self._index(index), id_field,
+                                        upsert=upsert),
+                          chunk_size, max_chunk_bytes, workers, max_retries)
+
+    def delete(self, where=None, index=None, id_field='_id', chunk_size=None,
+               max_chunk_bytes=None, workers=1, max_retries=3) -> dict:
+        """
+        Delete docs (by id) with the bulk API, see create().
+        :param where: id, list of ids or doc(s) w/ id_field
+                      i.e. {'_id': 'a1'} or ['a1', 'a2']
+        :return: response object
+        """
+        if isinstance(where, str):
+            where = [where]
+        return self._bulk(self._actions(where, 'delete', self._index(index), id_field),
+                          chunk_size, max_chunk_bytes, workers, max_retries)
 
     def set_index(self, idx):
         self.index = idx
 
+    def _actions(self, docs, op_type, index, id_field=None, upsert=False):
+        """
+        Returns a generator of bulk actions of docs.
+        """
+        for d in ([docs] if isinstance(docs, dict) else docs or []):
+            a = {'_op_type': op_type, '_index': index}
+            if isinstance(d, str):
+                a['_id'] = d
+            else:
+                d = dict(d)
+                _id = d.pop('_id', None)
+                if id_field and id_field != '_id':
+                    _id = d.get(id_field)
+                if _id is not None:
+                    a['_id'] = _id
+                if op_type == 'update':
+                    a.update({'doc': d, 'doc_as_upsert': upsert})
+                elif op_type != 'delete':
+                    a['_source'] = d
+            yield a
+
+    def _aggregate(self, search, index, agg=None, groupby=None, limit=None,
+                   page_size=1000) -> list:
+        """
+        Server-side aggregation (size=0), see read(agg=..., groupby=...).
+        Groups are fetched with a composite aggregation, page_size buckets
+        per request (after_key paging).
+        :return: [{<group keys>, 'count': <doc count>, '<field>_<type>': <value>}]
+        """
+        r = []
+        metrics = self._metrics(agg)
+        body = search.extra(size=0, track_total_hits=not groupby).to_dict()
+        body.pop('sort', None)
+        body.pop('_source', None)
+        if not groupby:
+            if metrics:
+                body['aggs'] = metrics
+            res = self.client.search(index=index, body=body)
+            row = {'count': res['hits']['total']['value']}
+            row.update({k: v['value'] for k, v in res.get('aggregations', {}).items()})
+            return [row]
+
+        sources = []
+        for g in (groupby if isinstance(groupby, list) else [groupby]):
+            if isinstance(g, dict):
+                for field, iv in g.items():
+                    kind = 'calendar_interval' if iv[-1] in 'wMqy' else 'fixed_interval'
+                    sources += [{field: {'date_histogram': {
+                        'field': field, kind: iv, 'format': 'strict_date_optional_time'}}}]
+            else:
+                sources += [{g: {'terms': {'field': g}}}]
+
+        after = None
+        size = min(page_size, limit) if limit else page_size
+        while limit is None or len(r) < limit:
+            composite = {'sources': sources, 'size': size}
+            if after:
+                composite['after'] = after
+            aggs = {'groupby': dict({'composite': composite},
+                                    **({'aggs': metrics} if metrics else {}))}
+            res = self.client.search(index=index, body=dict(body, aggs=aggs))
+            groups = res['aggregations']['groupby']
+            for b in groups['buckets']:
+                r += [dict(b['key'], count=b['doc_count'],
+                           **{k: b[k]['value'] for k in metrics})]
+            after = groups.get('after_key')
+            if not after or len(groups['buckets']) < size:
+                break
+        return r[:limit] if limit else r
+
+    def _bulk(self, actions, chunk_size=None, max_chunk_bytes=None, workers=1,
+              max_retries=3, max_errors=100) -> dict:
+        """
+        Send actions w/ streaming_bulk() on workers threads sharing the actions
+        iterator, 429 rejections are retried (exponential backoff).
+        """
+        s = Status(204, 'Nothing happened.')
+        s.docs, s.failed, s.errors = 0, 0, []
+        lock = threading.Lock()
+        actions = iter(actions)
+
+        def shared():
+            while True:
+                with lock:
+                    a = next(actions, None)
+                if a is None:
+                    return
+                yield a
+
+        def send():
+            for ok, item in helpers.streaming_bulk(
+                    self.client, shared(),
+                    chunk_size=chunk_size if chunk_size else BULK_CHUNK_SIZE,
+                    max_chunk_bytes=max_chunk_bytes if max_chunk_bytes else BULK_CHUNK_BYTES,
+                    raise_on_error=False, raise_on_exception=False,
+                    max_retries=max_retries):
+                with lock:
+                    if ok:
+                        s.docs += 1
+                        continue
+                    s.failed += 1
+                    if len(s.errors) < max_errors:
+                        res = list(item.values())[0]
+                        s.errors += [{'_id': res.get('_id'), 'status': res.get('status'),
+                                      'error': res.get('error')}]
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for job in [pool.submit(send) for _ in range(max(workers, 1))]:
+                    job.result()
+        except Exception as e:
+            s.code, s.message = 500, f"bulk: Server Error: {e}"
+            log.error(s.message)
+            return {'status': s.to_dict(), 'data': []}
+
+        if s.failed:
+            s.code, s.message = 500, f"bulk: {s.failed} doc(s) failed, {s.docs} doc(s) done."
+            log.error(f"{s.message} {s.errors[:3]}")
+        elif s.docs:
+            s.code, s.message = 200, 'OK'
+            log.info(f"bulk: {s.docs} doc(s) done.")
+        return {'status': s.to_dict(), 'data': []}
+
+    def _doc(self, hit, metadata=False) -> dict:
+        """
+        Returns _source of a (raw) hit, w/ _meta object if metadata.
+        """
+        d = hit.get('_source', {})
+        if metadata:
+            d['_meta'] = {k.lstrip('_'): (str(v) if k == 'sort' else v) \
+                          for k, v in hit.items() if k != '_source'}
+        return d
+
+    def _index(self, index=None, collection=None, table=None, db=None):
+        """
+        Returns index of a request (self.index is not changed).
+        """
+        for idx in [index, collection, table, db]:
+            if idx:
+                return idx
+        return self.index
+
+    def _iter_sliced(self, search, index, slices, batch_size, keep_alive,
+                     metadata=False):
+        """
+        Sliced scroll: one thread per slice, batches are handed over through a
+        bounded queue (at most 2 batches per slice in memory).
+        """
+        body = search.sort('_doc').extra(size=batch_size).to_dict()
+        batches = queue.Queue(maxsize=slices * 2)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def scroll(i):
+            sid = None
+            try:
+                res = self.client.search(index=index, scroll=keep_alive,
+                                         body=dict(body, slice={'id': i, 'max': slices}))
+                while res['hits']['hits']:
+                    sid = res.get('_scroll_id', sid)
+                    if not put([self._doc(hit, metadata) for hit in res['hits']['hits']]):
+                        break
+                    res = self.client.scroll(scroll_id=sid, scroll=keep_alive)
+                sid = res.get('_scroll_id', sid)
+                put(done)
+            except Exception as e:
+                put(e)
+            finally:
+                if sid:
+                    self.client.clear_scroll(scroll_id=sid)
+
+        with ThreadPoolExecutor(max_workers=slices) as pool:
+            for i in range(slices):
+                pool.submit(scroll, i)
+            try:
+                running = slices
+                while running:
+                    item = batches.get()
+                    if item is done:
+                        running -= 1
+                    elif isinstance(item, Exception):
+                        log.error(f"iter_read(): slice failed: {item}")
+                        raise item
+                    else:
+                        yield item
+            finally:
+                stop.set()
+
+    def _metrics(self, agg=None) -> dict:
+        """
+        Returns metric aggregations of agg {field: type|[types]}, named
+        '<field>_<type>' ('count' is a value_count).
+        """
+        r = {}
+        if isinstance(agg, dict):
+            for field, kinds in agg.items():
+                for kind in (kinds if isinstance(kinds, list) else [kinds]):
+                    r[f"{field}_{kind}"] = {
+                        'value_count' if kind == 'count' else kind: {'field': field}}
+        return r
+
+    def _msearch(self, requests, chunk) -> tuple[list, list]:
+        """
+        Returns _msearch searches (header, body pairs) and indexes of the
+        read() kwargs requests[i] for i in chunk.
+        """
+        keys = ['where', 'collection', 'db', 'projection', 'sort', 'select',
+                'table', 'query', 'index', 'interval']
+        searches, indexes = [], []
+        for i in chunk:
+            kw = requests[i]
+            index, search = self._request(**{k: kw.get(k) for k in keys})
+            offset = kw.get('offset') if kw.get('offset') else 0
+            limit = kw.get('limit') if kw.get('limit') is not None else 1000
+            searches += [{'index': index}, search.extra(
+                track_total_hits=kw.get('track_total_hits', False))[
+                    offset:offset + limit].to_dict()]
+            indexes += [index]
+        return searches, indexes
+
+    def _msearch_results(self, requests, chunk, indexes, responses) -> list:
+        """
+        Returns response objects of an _msearch request (responses: the
+        "responses" list or the exception raised sending it).
+        """
+        r = []
+        if isinstance(responses, Exception):
+            return [{'status': {'code': 500, 'message': f"read_many(): Server Error: {responses}"},
+                     'data': []} for _ in chunk]
+        for i, index, res in zip(chunk, indexes, responses):
+            if 'error' in res:
+                err = res['error']
+                r += [{'status': {'code': res.get('status', 500), 'message':
+                                  err.get('reason', err) if isinstance(err, dict) else err},
+                       'data': []}]
+                continue
+            s = Status(404, 'No data found.')
+            s.table = index
+            s.kind = 'match'
+            if requests[i].get('track_total_hits'):
+                s.hits = res['hits']['total']
+            r += [self._response([self._doc(hit, requests[i].get('metadata')) \
+                                  for hit in res['hits']['hits']], s)]
+        return r
+
+    def _request(self, where=None, collection=None, db=None, projection=None,
+                 sort=None, select=None, table=None, query=None, index=None,
+                 interval=None):
+        """
+        Returns (index, Search) of a read() request.
+        """
+        index = self._index(index, collection, table, db)
+        search = self._search(where, query, interval).index(index)
+        source = self._source(projection, select)
+        if source:
+            search = search.source(**source)
+        if sort:
+            search = search.sort(*self._sort(sort))
+        return index, search
+
     def _response(self, data, status) -> dict:
         r = {'status': {'code': None, 'message': None}, 'data': []}
 
@@ -107,6 +521,206 @@ class ElasticCRUD(ElasticConnection):
 
         return r
 
+    def _search(self, where=None, query=None, interval=None, ts_field=None):
+        """
+        Returns a new Search (no index) w/ where/query filters and time range.
+        Values w/ wildcards (* or ?) are matched with a wildcard query, lists
+        with terms, other values with match.
+        """
+        q = dict(where) if query is None and where else {}
+        if isinstance(query, dict):
+            q.update(query)
+        search = Search(using=self.client)
+        for k, v in q.items():
+            if isinstance(v, (list, tuple)):
+                search = search.filter('terms', **{k: list(v)})
+            elif isinstance(v, str) and ('*' in v or '?' in v):
+                search = search.filter('wildcard', **{k: v})
+            else:
+                search = search.filter('match', **{k: v})
+        return search.filter('range', **ts_range(
+            interval=interval if interval else {'hour': 1}, ts_field=ts_field))
+
+    def _sort(self, sort) -> list:
+        """
+        Returns ES sort clauses, {field: 1|-1|'asc'|'desc'} or clauses as-is.
+        """
+        if isinstance(sort, dict):
+            return [{k: {'order': 'desc' if v in [-1, 'desc'] else 'asc'}} \
+                    for k, v in sort.items()]
+        return sort if isinstance(sort, list) else [sort]
+
+    def _source(self, projection=None, select=None):
+        """
+        Returns _source filtering, {'includes': [], 'excludes': []} (or None).
+        """
+        r = {}
+        fields = projection if isinstance(projection, dict) else \
+            {k: True for k in (projection or []) + (select or [])}
+        if isinstance(projection, dict) and select:
+            fields.update({k: True for k in select})
+        includes = [k for k, v in fields.items() if v]
+        excludes = [k for k, v in fields.items() if not v]
+        if includes:
+            r['includes'] = includes
+        if excludes:
+            r['excludes'] = excludes
+        return r if r else None
+
+
+class AsyncElasticCRUD(ElasticCRUD):
+    """
+    asyncio ElasticCRUD: read(), read_many() and iter_read() run on the async
+    client (requires aiohttp), gather() runs many reads concurrently. Aggregations
+    and bulk writes (create/update/delete) use the shared sync client, on a
+    thread for aggregations.
+    """
+
+    def __init__(self, index=None, max_concurrency=10) -> None:
+        """
+        :param index: default index
+        :param max_concurrency: max number of requests in flight in gather()
+        """
+        super().__init__(index)
+        self.aclient = None
+        self.max_concurrency = max_concurrency
+        if config['elastic']:
+            if AsyncElasticsearch is None or aiohttp is None:
+                log.error('AsyncElasticCRUD: aiohttp is required (elasticsearch[async]).')
+            else:
+                self.aclient = AsyncElasticsearch(
+                    hosts=[f'https://{self.host}:9243'],
+                    http_auth=(config['elastic']['username'],
+                               config['elastic']['password']),
+                    ssl_show_warn=False,
+                    request_timeout=self.timeout, max_retries=10,
+                    retry_on_timeout=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self) -> None:
+        if self.aclient:
+            await self.aclient.close()
+        return
+
+    async def gather(self, *requests, return_exceptions=False) -> list:
+        """
+        Run reads concurrently (at most max_concurrency in flight).
+        :param requests: read() kwargs i.e. {'where': {'host': 'r1'}, 'limit': 20}
+        :param return_exceptions: see asyncio.gather()
+        :return: [<response object>] (same order as requests)
+        """
+        sem = asyncio.Semaphore(self.max_concurrency)
+
+        async def read(kwargs):
+            async with sem:
+                return await self.read(**kwargs)
+
+        return await asyncio.gather(*(read(kw) for kw in requests),
+                                    return_exceptions=return_exceptions)
+
+    async def iter_read(self, where=None, collection=None, db=None, table=None,
+                        query=None, index=None, interval=None, sort=None,
+                        batch_size=1000, keep_alive='1m', metadata=False):
+        """
+        Async iterator over batches of docs (point-in-time + search_after), see
+        ElasticCRUD.iter_read().
+        :return: async generator of [<dict>]
+        """
+        index, search = self._request(where, collection, db, None, sort, None,
+                                      table, query, index, interval)
+        async for batch in self._iter_pit(search, index, sort, batch_size,
+                                          keep_alive, metadata):
+            yield batch
+
+    async def read(self, where=None, collection=None, db=None, projection=None,
+                   sort=None, agg=None, select=None, table=None, groupby=None,
+                   like=None, query=None, index=None, limit=None, offset=None,
+                   interval=None, metadata=False, track_total_hits=False) -> dict:
+        """
+        See ElasticCRUD.read(), without limit/offset all matching docs are
+        paged through a point-in-time.
+        :return: response object
+        """
+        r = []
+        s = Status(404, 'No data found.')
+        index, search = self._request(where, collection, db, projection, sort,
+                                      select, table, query, index, interval)
+        s.table = index
+        if agg or groupby:
+            s.kind = 'agg'
+            return self._response(await asyncio.to_thread(
+                self._aggregate, search, index, agg, groupby, limit), s)
+
+        s.kind = 'match'
+        log.debug(f"Sending request: {search.to_dict()}")
+        if limit is None and offset is None:
+            async for batch in self._iter_pit(search, index, sort, 1000, '1m', metadata):
+                r += batch
+        else:
+            offset = offset if offset else 0
+            body = search.extra(track_total_hits=track_total_hits)[
+                offset:offset + (limit if limit is not None else 1000)].to_dict()
+            res = await self.aclient.search(index=index, body=body)
+            r = [self._doc(hit, metadata) for hit in res['hits']['hits']]
+            if track_total_hits:
+                s.hits = res['hits']['total']
+        return self._response(r, s)
+
+    async def read_many(self, requests, chunk_size=50) -> list:
+        """
+        See ElasticCRUD.read_many(), _msearch requests are sent on the async
+        client, agg/groupby requests run concurrently with gather().
+        :return: [<response object>] (same order as requests)
+        """
+        r = [None] * len(requests)
+        aggs = [i for i, kw in enumerate(requests) if kw.get('agg') or kw.get('groupby')]
+        pending = [i for i, kw in enumerate(requests) \
+                   if not (kw.get('agg') or kw.get('groupby'))]
+        for i, d in zip(aggs, await self.gather(*(requests[i] for i in aggs))):
+            r[i] = d
+
+        for j in range(0, len(pending), chunk_size):
+            chunk = pending[j:j+chunk_size]
+            searches, indexes = self._msearch(requests, chunk)
+            try:
+                log.debug(f"read_many(): sending {len(chunk)} queries")
+                res = (await self.aclient.msearch(searches=searches))['responses']
+            except Exception as e:
+                log.error(f"read_many(): Server Error: {e}")
+                res = e
+            for i, d in zip(chunk, self._msearch_results(requests, chunk, indexes, res)):
+                r[i] = d
+        return r
+
+    async def _iter_pit(self, search, index, sort=None, batch_size=1000,
+                        keep_alive='1m', metadata=False):
+        pit = (await self.aclient.open_point_in_time(
+            index=index, keep_alive=keep_alive))['id']
+        try:
+            after = None
+            search = search.index().sort(*(self._sort(sort) if sort else ['_shard_doc'])) \
+                .extra(size=batch_size, track_total_hits=False)
+            while True:
+                body = search.extra(pit={'id': pit, 'keep_alive': keep_alive})
+                if after:
+                    body = body.extra(search_after=after)
+                res = await self.aclient.search(body=body.to_dict())
+                pit = res.get('pit_id', pit)
+                hits = res['hits']['hits']
+                if not hits:
+                    break
+                yield [self._doc(hit, metadata) for hit in hits]
+                if len(hits) < batch_size:
+                    break
+                after = hits[-1]['sort']
+        finally:
+            await self.aclient.close_point_in_time(id=pit)
+
 
 def ts_range(start_dt=None, end_dt=None, interval=None, ts_field=None, indexes=None) -> dict:
     """
@@ -170,8 +784,17 @@ dao = ElasticCRUD()
 
 # ### v1.0.0 auto_elastic
 # d- implement read() using default index
-# d- allow easy change of index on read()
+# d- allow easy change of index on read() (per call, self.index unchanged)
 # d- show _meta object in every doc (hide: default)
-# - add limit param (default: 1000)
-# - add agg type: count
-# - aggregate on selected fields
+# d- stream large reads: iter_read() w/ point-in-time + search_after, or
+#    sliced scroll across threads
+# d- add limit param (default: none, full scan), offset, projection/select,
+#    sort and track_total_hits pushed into the request
+# d- add agg type: count
+# d- aggregate on selected fields (server-side: sum/avg/min/max/cardinality,
+#    groupby terms/date_histogram w/ composite paging)
+# d- implement create(), update() and delete() w/ chunked, parallel bulk
+#    requests (retry on 429, per-doc errors in status)
+# d- read() filters applied (new Search per call), shared thread-safe client
+# d- AsyncElasticCRUD: async read()/iter_read() and gather() (concurrent reads)
+# d- read_many(): many small reads batched in _msearch requests
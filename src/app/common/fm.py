@@ -1,12 +1,34 @@
+from array import array
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+from functools import lru_cache, partial
+from itertools import islice
+import errno
+import fnmatch
+import hashlib
 import json
+import mmap
 import os
+import posixpath
 import re
+import shutil
+import stat
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from common.utils import deprecated, log, envar, Status
 
 __authors__ = ['randollrr']
 __version__ = '2.5.0-dev.5'
 
+CHUNK_SIZE = 8*1024*1024
+
 
 class FileManager:
     """
@@ -15,8 +37,8 @@ class FileManager:
     """
 
     def __init__(self, indir=None, outdir=None, arcdir=None, errdir=None, \
-        known_dir=None, bucket=None) -> None:
-        self.reset(indir, outdir, arcdir, errdir, known_dir, bucket)
+        known_dir=None, bucket=None, shard=None) -> None:
+        self.reset(indir, outdir, arcdir, errdir, known_dir, bucket, shard)
 
     def cd(self, newpath) -> Status:
         s = Status(204, 'Nothing happened')
@@ -30,6 +52,66 @@ class FileManager:
             s.message = s_fp.message
         return s
 
+    def checksum(self, path, algo='sha256', chunk_size=None) -> str:
+        """
+        Content hash of a file, streamed in chunks (memory-mapped when the
+        file is larger than one chunk).
+        :param path: file path
+        :param algo: hashlib algorithm name
+        :param chunk_size: bytes per update (default: 8 MiB)
+        :return: hex digest (or None if file cannot be read)
+        """
+        chunk_size = chunk_size if chunk_size else CHUNK_SIZE
+        h = hashlib.new(algo)
+        try:
+            with open(self.fullpath(path), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size > chunk_size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, \
+                            memoryview(m) as mv:
+                        for i in range(0, size, chunk_size):
+                            h.update(mv[i:i+chunk_size])
+                else:
+                    h.update(f.read())
+        except OSError as e:
+            log.error(f"fm.checksum(): Couldn't read file: {e}")
+            return None
+        return h.hexdigest()
+
+    def checksums(self, files, directory=None, algo='sha256', workers=None) -> dict:
+        """
+        Hash files in parallel (hashlib releases the GIL on large buffers).
+        :param files: list [] of filenames (or paths when directory is None)
+        :param directory: path
+        :param algo: hashlib algorithm name
+        :param workers: max number of threads
+        :return: {filename: hex digest}
+        """
+        r = {}
+        if isinstance(files, list) and files:
+            paths = [f"{directory}/{fn}" if directory else fn for fn in files]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                r = dict(zip(files, pool.map(
+                    lambda p: self.checksum(p, algo=algo), paths)))
+        return r
+
+    def copy(self, fn, src, dst, new_fn=None, resume=True) -> Status:
+        """
+        Copy file using kernel-side copy (copy_file_range, sendfile) and
+        preserve timestamps. Data is written to "<dst>/<new_fn>.part" first,
+        an interrupted copy is resumed from where it stopped when the source
+        is unchanged (path, size and mtime recorded in "<new_fn>.part.src").
+        :param fn: filename
+        :param src: source path (only)
+        :param dst: destination path (only)
+        :param new_fn: destination filename (default: fn)
+        :param resume: resume from existing ".part" file
+        :return: Status (with "bytes", "seconds" and "throughput" in MB/s)
+        """
+        src, dst = self.fullpath(src), self.fullpath(dst)
+        return self._copy_file(f"{src}/{fn}", f"{dst}/{new_fn if new_fn else fn}",
+                               resume=resume)
+
     def crawl_dir(self, path=None, ret=None) -> tuple[list, Status]:
         r = []
         s = Status(204, 'Nothing happened.')
@@ -40,28 +122,22 @@ class FileManager:
             path = self.pwd()
         if isinstance(path, str):
             path = self.fullpath(path)
-            res = os.walk(path)
-            if res:
-                t = []
+            if self.exists(path):
                 s.code = 200
                 s.message = 'OK'
 
-                for p in res:
-                    t += [{
-                        'path': p[0],
-                        'dirs': p[1],
-                        'files': p[2],
-                    }]
-                if ret == 'list':
-                    for i in t:
-                        for d in i['dirs']:
-                            for f in i['files']:
-                                r += [f"{i['path']}/{d}/{f}"]
-                            r += [f"{i['path']}/{d}/"]
-                elif ret == 'json':
-                    r = json.dumps(r, indent=4)
+                if ret in ['list', 'json']:
+                    for p, st in self.iter_tree(path, dirs=True):
+                        r += [f"{p}/" if stat.S_ISDIR(st.st_mode) else p]
+                    if ret == 'json':
+                        r = json.dumps(r, indent=4)
                 else:
-                    r = t; del t  # returns dict
+                    for p in os.walk(path):  # returns dict
+                        r += [{
+                            'path': p[0],
+                            'dirs': p[1],
+                            'files': p[2],
+                        }]
         return r, s
 
     def del_dir(self, path):
@@ -102,10 +178,12 @@ class FileManager:
                 files = self.ls(path, fn_pattern=fn_pattern, fn_only=True)
 
             if isinstance(files, list):
+                sharded = self._is_sharded(path)
                 for fn in files:
+                    d = self._find_shard(path, fn) if sharded else path
                     try:
-                        os.remove(os.path.join(path, fn))
-                        log.info(f"deleted: {path}/{fn}")
+                        os.remove(os.path.join(d, fn))
+                        log.info(f"deleted: {d}/{fn}")
                         r = True
                     except Exception as e:
                         log.error(f"Couldn't remove file: {e}")
@@ -174,45 +252,22 @@ class FileManager:
         return r
 
     def fullpath(self, path, status=False, di=None) -> object:
-        r = path
-        s = Status(204, 'Nothing happened')
-
-        _wd = di if di else self._basedir
-
-        def upone(_p, _c=0) -> str:
-            _r, _t, _n = '', _p.split('/'), []
-            _idx = _t.index('..')
-            if _idx:
-                for _i in range(0, len(_t)):
-                    if _i != _t.index('..')-1 and _i != _t.index('..'):
-                        _n += [_t[_i]]
-                _r = '/' if _n and '/'.join(_n) == '' else '/'.join(_n)
-            if '..' in _r:
-                _c += 1
-                _r = upone(_r, _c)
-            if _idx == 0 and _c > 0:
-                _r = '/'
-            return _r
-
-        if isinstance(path, str):
-            if path.startswith('..'):
-                r = upone(f"{_wd}/{path}")
-            elif '..'  in path:
-                r = upone(path)
-            elif path.startswith('.'):
-                if len(path) == 1 or (len(path) > 1 and path[1] == '/'):
-                    r = path.replace('.', f"{_wd}")
-                else:
-                    r = f"{_wd}/{path}"
-            elif path.endswith('/.'):
-                r = path[:-2]
-            elif path and not path.startswith('/'):
-                r = f"{_wd}/{path}"
-        if self.exists(r):
-            s.code = 200
-            s.message = 'Parsing attempted (successfully).'
+        """
+        Resolve path (relative to pwd or di) without touching the filesystem,
+        unless status=True.
+        :param path: absolute or relative path (supports ".", "..")
+        :param status: also return Status (200 if path exists)
+        :param di: base directory (default: pwd)
+        :return: path or (path, Status)
+        """
+        r = _resolve(di if di else self._basedir, path) \
+            if isinstance(path, str) else path
 
         if status:
+            s = Status(204, 'Nothing happened')
+            if self.exists(r):
+                s.code = 200
+                s.message = 'Parsing attempted (successfully).'
             return r, s
         else:
             return r
@@ -220,6 +275,60 @@ class FileManager:
     def is_dir(self, path) -> tuple[bool, Status]:
         ...
 
+    def iter_tree(self, path=None, fn_pattern=None, glob=None, max_depth=None,
+                  exclude=None, dirs=False):
+        """
+        Walk directory tree lazily (streaming alternative to crawl_dir()).
+        :param path: root directory (default: pwd)
+        :param fn_pattern: filter based on filename pattern (regex)
+        :param glob: filter based on filename shell-style pattern i.e. "*.csv"
+        :param max_depth: 0 = entries of path only (default: no limit)
+        :param exclude: list of directory names/globs not to descend into
+        :param dirs: also yield directories
+        :return: generator of (path, stat)
+        """
+        if not path:
+            path = self.pwd()
+        path = self.fullpath(path)
+        path = path[:-1] if len(path) > 1 and path.endswith('/') else path
+        rx = re.compile(fn_pattern) if fn_pattern else None
+        if isinstance(exclude, str):
+            exclude = [exclude]
+
+        def selected(_name):
+            if rx and not rx.search(_name):
+                return False
+            if glob and not fnmatch.fnmatchcase(_name, glob):
+                return False
+            return True
+
+        stack = [(path, 0)]
+        while stack:
+            d, depth = stack.pop()
+            try:
+                it = os.scandir(d)
+            except OSError as e:
+                log.error(f"fm.iter_tree(): Couldn't list directory: {e}")
+                continue
+            sub = []
+            with it:
+                for f in it:
+                    try:
+                        is_dir = f.is_dir(follow_symlinks=False)
+                        if is_dir:
+                            if exclude and any(fnmatch.fnmatchcase(f.name, x) \
+                                    for x in exclude):
+                                continue
+                            if max_depth is None or depth < max_depth:
+                                sub += [(f.path, depth+1)]
+                            if not dirs:
+                                continue
+                        if selected(f.name):
+                            yield f.path, f.stat(follow_symlinks=False)
+                    except OSError:
+                        continue  # -- removed between listing and stat
+            stack += reversed(sub)
+
     def latest(self, directory=None, fn_pattern=None, fn_only=False, path=None,
                ret=None):
         """
@@ -281,37 +390,103 @@ class FileManager:
         """
         r = False
 
-        def newfilename(fnum):  # -- add <filename>_1[+n]
-            if fnum == 0:
-                _r = fn
-            else:
-                try:
-                    nfn, ext = fn.split('.')
-                    _r = f"{nfn}_{fnum}.{ext}"
-                except Exception as e:
-                    _r = f"{fn}_{fnum}"
-                    log.error(f"Error: {e}")
-            return _r
-
-        def do_move(fnum=0):
-            _r = False
-            new_fn = newfilename(fnum)
-            if not self.exists(f"{dst}/{new_fn}"):
-                if self.exists(f"{src}/{fn}"):
-                    os.rename(f"{src}/{fn}", f"{dst}/{new_fn}")
-                    log.info(f"moved: [{src}/{fn}] to [{dst}/{new_fn}]")
-                    _r = True
-            else:
+        def do_move():
+            # -- resolve a free name (<filename>_1[+n]) in its own shard
+            fnum = 0
+            while True:
+                new_fn = self._newfilename(fn, fnum)
+                d = self.shard_dir(dst, new_fn) if sharded else dst
+                if not self.exists(f"{d}/{new_fn}"):
+                    break
                 fnum += 1
-                _r = do_move(fnum)
-            return _r
+            if not self.exists(f"{src}/{fn}"):
+                return False
+            if sharded:
+                os.makedirs(d, exist_ok=True)
+            self._rename(f"{src}/{fn}", f"{d}/{new_fn}")
+            log.info(f"moved: [{src}/{fn}] to [{d}/{new_fn}]")
+            return True
 
-        # -- move files (recursively avoid name conflict)
         if src and dst:
+            if self._is_sharded(src):
+                src = self._find_shard(src, fn)
+            sharded = self._is_sharded(dst)
             r = do_move()
 
         return r
 
+    def move_many(self, files, src, dst, workers=None) -> tuple[dict, Status]:
+        """
+        Move files in batch (i.e. input to archive). Name conflicts are
+        resolved from a single listing of dst, moves run on a thread pool and
+        fall back to copy+delete across devices (see copy()).
+        :param files: list [] of filenames
+        :param src: source path (only)
+        :param dst: destination path (only)
+        :param workers: max number of threads (default: ThreadPoolExecutor's)
+        :return: {filename: Status}, Status
+        """
+        r = {}
+        s = Status(204, 'Nothing happened.')
+
+        if not (src and dst and isinstance(files, list) and files):
+            return r, s
+        src, dst = self.fullpath(src), self.fullpath(dst)
+        src_sharded, dst_sharded = self._is_sharded(src), self._is_sharded(dst)
+        try:
+            taken = {dst: set(os.listdir(dst))}
+        except OSError as e:
+            s.code = 404
+            s.message = f"fm.move_many(): Couldn't list destination: {e}"
+            log.error(s.message)
+            return r, s
+
+        def listing(_d):
+            if _d not in taken:
+                try:
+                    taken[_d] = set(os.listdir(_d))
+                except FileNotFoundError:
+                    taken[_d] = set()
+            return taken[_d]
+
+        # -- resolve unique destination names (add <filename>_1[+n]), one
+        #    listing per destination (shard) directory
+        jobs = []
+        for fn in dict.fromkeys(files):
+            fnum = 0
+            while True:
+                new_fn = self._newfilename(fn, fnum)
+                d = self.shard_dir(dst, new_fn) if dst_sharded else dst
+                if new_fn not in listing(d):
+                    break
+                fnum += 1
+            listing(d).add(new_fn)
+            jobs += [(fn, f"{self._find_shard(src, fn) if src_sharded else src}/{fn}",
+                      f"{d}/{new_fn}")]
+
+        def do_move(_fn, _src, _dst):
+            try:
+                if dst_sharded:
+                    os.makedirs(os.path.dirname(_dst), exist_ok=True)
+                self._rename(_src, _dst)
+                log.debug(f"moved: [{_src}] to [{_dst}]")
+                return Status(200, _dst)
+            except FileNotFoundError:
+                return Status(404, f"file not found: {_src}")
+            except Exception as _e:
+                log.error(f"Couldn't move file: {_e}")
+                return Status(500, f"{_e}")
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for (fn, _, _), res in zip(jobs, pool.map(lambda j: do_move(*j), jobs)):
+                r[fn] = res
+
+        moved = sum(1 for x in r.values() if x.code == 200)
+        s.code = 200 if moved == len(r) else 500
+        s.message = f"moved: {moved}/{len(r)} file(s) to [{dst}]"
+        log.info(s.message)
+        return r, s
+
     def oldest(self, directory=None, fn_pattern=None, fn_only=False, path=None,
                ret=None):
         """
@@ -339,11 +514,12 @@ class FileManager:
         return self._basedir
 
     def reset(self, indir=None, outdir=None, arcdir=None, errdir=None, \
-        known_dir=None, bucket=None) -> None:
+        known_dir=None, bucket=None, shard=None) -> None:
         """
         Reset all state.
         """
         self._bucket = bucket if bucket else ''
+        self._shard = shard
         self._basedir = f"{envar('PWD')}"
         self.known_dir = known_dir
         self._output_fmt = 'list'
@@ -362,22 +538,98 @@ class FileManager:
         :return None: no return values
         """
         if retain > 0:
-            del_list = self._ts_sorted_file('list', directory, \
-                fn_pattern=f".*{fn}.*")
-            if len(del_list) > retain:
+            depth = 0
+            if self._is_sharded(directory):
+                depth = 3 if self._shard == 'date' else 2
+            self.retention(directory, keep_last=retain, fn_pattern=f".*{fn}.*",
+                           max_depth=depth)
+            log.info(f"applied retention policy: {directory}")
+        return
+
+    def retention(self, path=None, keep_last=None, max_age=None, max_bytes=None,
+                  fn_pattern=None, max_depth=None, exclude=('.*',), dry_run=False,
+                  workers=None) -> tuple[dict, Status]:
+        """
+        Apply retention policies to every directory of a tree in one pass
+        (i.e. the whole dir_struct(), default: pwd). Policies are evaluated per
+        directory (per bucket directory across its shards), newest files first
+        (by ctime); a file is deleted as soon as one policy applies.
+        :param path: base path
+        :param keep_last: number of files to retain
+        :param max_age: max age in seconds (or timedelta)
+        :param max_bytes: max total size (bytes) retained
+        :param fn_pattern: only consider filenames matching pattern (regex)
+        :param max_depth: see iter_tree()
+        :param exclude: directory names/globs not to descend into (default:
+                        hidden state dirs i.e. .processing, .index, .cache)
+        :param dry_run: only report what would be deleted
+        :param workers: max number of threads used to delete files
+        :return: {'files': [...], 'count': n, 'bytes': n, 'errors': [...]}, Status
+        """
+        r = {'files': [], 'count': 0, 'bytes': 0, 'errors': []}
+        s = Status(204, 'Nothing to delete.')
 
-                # -- unpack filename
-                t = []
-                for f in del_list:
-                    t += [f[1]]
-                del_list = t[:len(t)-retain]
-                log.debug(f"list of file to delete: {del_list}")
+        if isinstance(max_age, timedelta):
+            max_age = max_age.total_seconds()
+        now = time.time()
 
-                self.del_files(directory, del_list)
-                del del_list, t
+        # -- single pass: group (ctime, path, size) per directory, files of a
+        #    sharded bucket directory are grouped under the bucket directory
+        buckets = [x.rstrip('/') for x in (self.INPUT, self.OUTPUT, self.ARCHIVE,
+                   self.ERRORED) if self._is_sharded(x)]
+        groups = {}
+        for p, st in self.iter_tree(path, fn_pattern=fn_pattern, max_depth=max_depth,
+                                    exclude=exclude):
+            if stat.S_ISREG(st.st_mode):
+                d = os.path.dirname(p)
+                d = next((b for b in buckets if d == b or d.startswith(f"{b}/")), d)
+                groups.setdefault(d, []).append((int(st.st_ctime), p, st.st_size))
 
-            log.info(f"applied retention policy: {directory}")
-        return
+        # -- apply policies
+        for files in groups.values():
+            files.sort(reverse=True)
+            kept, kept_bytes, over = 0, 0, False
+            for ctime, p, size in files:
+                if max_bytes is not None and kept_bytes + size > max_bytes:
+                    over = True
+                if over or (keep_last is not None and kept >= keep_last) or \
+                        (max_age is not None and now - ctime > max_age):
+                    r['files'] += [p]
+                    r['bytes'] += size
+                else:
+                    kept += 1
+                    kept_bytes += size
+        r['count'] = len(r['files'])
+        del groups
+
+        if not r['files']:
+            return r, s
+        log.debug(f"list of file to delete: {r['files']}")
+        if dry_run:
+            s.code = 200
+            s.message = f"dry-run: would delete {r['count']} file(s), {r['bytes']} bytes"
+            log.info(s.message)
+            return r, s
+
+        def unlink(_p):
+            try:
+                os.remove(_p)
+            except FileNotFoundError:
+                pass
+            except Exception as _e:
+                return f"{_p}: {_e}"
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            r['errors'] = [e for e in pool.map(unlink, r['files']) if e]
+        if r['errors']:
+            s.code = 500
+            log.error(f"Couldn't remove file(s): {r['errors']}")
+        else:
+            s.code = 200
+        s.message = f"deleted {r['count']-len(r['errors'])}/{r['count']} file(s), " \
+                    f"{r['bytes']} bytes"
+        log.info(f"retention: {s.message}")
+        return r, s
 
     @deprecated
     def setbucket(self, dirname) -> None:
@@ -388,14 +640,17 @@ class FileManager:
         self.set_bucket(dirname)
         return
 
-    def set_bucket(self, dirname, auto_create=True) -> None:
+    def set_bucket(self, dirname, auto_create=True, shard=None) -> None:
         """
         Add a "bucket" to directory structure.
         :param dirname: name to set the subdirectory
+        :param shard: optional sub-directory layout, see shard_dir()
         :return None: no return values
         """
         if not self._bucket:
             self._bucket = str(dirname)
+            if shard:
+                self._shard = shard
             self.dir_struct(auto_create=auto_create)
             log.info(f"Bucket is now set to: {self._bucket}.")
         else:
@@ -405,12 +660,30 @@ class FileManager:
 
     def set_returns(self, ret='dict') -> None:
         """
-        Set data output format to 'list', 'dict' or 'json' (default value: list).
+        Set data output format to 'list', 'dict', 'json' or 'table' (see
+        FileTable) (default value: list).
         """
         if ret:
             self._output_fmt = ret
         return
 
+    def shard_dir(self, directory, fn=None) -> str:
+        """
+        Returns the shard (sub-directory) of a bucket directory where fn goes:
+        - 'date': <directory>/YYYY/MM/DD (UTC, today)
+        - 'hash': <directory>/ab/cd (md5 of filename)
+        :param directory: bucket directory (i.e. INPUT, ARCHIVE)
+        :param fn: filename (required for 'hash')
+        :return: path
+        """
+        directory = directory.rstrip('/')
+        if self._shard == 'date':
+            return f"{directory}/{time.strftime('%Y/%m/%d', time.gmtime())}"
+        elif self._shard == 'hash' and fn:
+            h = hashlib.md5(fn.encode()).hexdigest()
+            return f"{directory}/{h[:2]}/{h[2:4]}"
+        return directory
+
     def touch(self, fn, time=None) -> None:
         path = self.fullpath(fn)
         with open(path, 'a') as f:
@@ -429,9 +702,10 @@ class FileManager:
         :param directory: provide path
         :param fn_pattern: filter based on filename pattern
         :param fn_only: returns list [] of filenames only
-        :param ret: change type of return values to "list of objects[dict, json]"
-                    or "list of list"
-        :return: list of [filename, timestamp], list of [<dict>] or list of [<json>]
+        :param ret: change type of return values to "list of objects[dict, json]",
+                    "list of list" or "table" (FileTable)
+        :return: list of [filename, timestamp], list of [<dict>], list of [<json>]
+                 or FileTable
         """
         r = []
 
@@ -445,53 +719,45 @@ class FileManager:
         log.debug(f"directory: {directory}")
         log.debug(f"path-exists: {'yes' if self.exists(directory) else 'no'}")
         if directory and self.exists(directory):
-            t = []
-
-            # f_list = sorted([[int(os.stat(os.path.join(directory, f)).st_ctime), f] \
-            #     for f in os.listdir(directory)])
-
-            f_list = []
-            for f in os.scandir(directory):
-                ctime = int(os.stat(os.path.join(directory, f.name)).st_ctime)
-                if ret == 'list':
-                    f_list += [[ctime, f.name]]
-                else:
+            if ret == 'table':
+                r = FileTable()
+                for f, st in self._scan_shards(directory, fn_pattern):
+                    r.append(f.name, st)
+                # -- latest/oldest: one-row table (same order as 'list')
+                if req in ['latest', 'oldest'] and len(r):
+                    pick = max if req == 'latest' else min
+                    r = r._take([pick(range(len(r)),
+                                      key=lambda i: (r.ctime[i], r.name[i]))])
+            elif not ret == 'list':
+                f_list = []
+                for f, st in self._scan_shards(directory, fn_pattern):
                     f_list += [{
                         'filename': f.name,
                         'is_dir': True if f.is_dir(follow_symlinks=True) else False,
                         'is_symlink': True if f.is_symlink() else False,
-                        'size': f.stat().st_size,
+                        'size': st.st_size,
                         'stats': {
-                            'atime': int(f.stat().st_atime),
-                            'ctime': int(f.stat().st_ctime),
-                            'mtime': int(f.stat().st_mtime)}
+                            'atime': int(st.st_atime),
+                            'ctime': int(st.st_ctime),
+                            'mtime': int(st.st_mtime)}
                     }]
-
-            if not ret == 'list':
-                if f_list:
-                    f_list.sort(key=lambda x: x['filename'])
+                f_list.sort(key=lambda x: x['filename'])
                 if ret == 'json':
                     r = json.dumps(f_list, indent=4)
                 else:
                     r = f_list
             else:
-                f_list = sorted(f_list)
-
-                if fn_pattern:
-                    for n in sorted(f_list):
-                        if re.search(fn_pattern, n[1]):
-                            t += [[n[0], n[1]]]
-                elif f_list:
-                    t = f_list
-                del f_list
+                t = [[int(st.st_ctime), f.name] for f, st in \
+                    self._scan_shards(directory, fn_pattern)]
 
-                # -- apply filter
+                # -- apply filter (single pass for latest/oldest, no full sort)
                 if req == 'list':
+                    t.sort()
                     r = t
                 elif req == 'latest' and t:
-                    r = [t[len(t)-1][0], t[len(t)-1][1]]
+                    r = max(t)
                 elif req == 'oldest' and t:
-                    r = [t[0][0], t[0][1]]
+                    r = min(t)
                 del t
 
                 # -- return simplified list
@@ -501,8 +767,686 @@ class FileManager:
                     r = [x[1] for x in r]
         return r
 
+    def _copy_file(self, src, dst, resume=True) -> Status:
+        s = Status(204, 'Nothing happened.')
+        part = f"{dst}.part"
+        st = time.perf_counter()
+        try:
+            with open(src, 'rb') as fsrc:
+                fst = os.fstat(fsrc.fileno())
+                size = fst.st_size
+                ident = {'path': src, 'size': size, 'mtime_ns': fst.st_mtime_ns}
+                offset = 0
+                if resume and os.path.exists(part):
+                    try:
+                        with open(f"{part}.src", 'r') as f:
+                            if json.load(f) == ident:
+                                offset = min(os.path.getsize(part), size)
+                    except (OSError, ValueError):
+                        pass  # -- unknown origin, start over
+                if not offset:
+                    with open(f"{part}.src", 'w') as f:
+                        json.dump(ident, f)
+                with open(part, 'r+b' if offset else 'wb') as fdst:
+                    fdst.truncate(offset)
+                    copied = _kernel_copy(fsrc.fileno(), fdst.fileno(), offset, size)
+            if copied < size:
+                raise OSError(errno.EIO, f"incomplete copy ({copied}/{size} bytes)")
+            shutil.copystat(src, part)
+            os.replace(part, dst)
+            os.remove(f"{part}.src")
+        except FileNotFoundError as e:
+            s.code = 404
+            s.message = f"fm.copy(): file not found: {e}"
+            log.error(s.message)
+            return s
+        except Exception as e:
+            s.code = 500
+            s.message = f"fm.copy(): Error ocurred. : {e}"
+            log.error(s.message)
+            return s
+        s.code = 200
+        s.message = f"copied: [{src}] to [{dst}]"
+        s.bytes = copied - offset
+        s.seconds = round(time.perf_counter() - st, 6)
+        s.throughput = round(s.bytes / s.seconds / 1024**2, 2) if s.seconds else 0
+        log.info(f"{s.message} ({s.bytes} bytes"
+                 f"{f', resumed at {offset}' if offset else ''}, {s.throughput} MB/s)")
+        return s
+
+    def _find_shard(self, directory, fn) -> str:
+        """
+        Returns the shard of a sharded bucket directory holding fn.
+        """
+        if os.path.exists(f"{directory}/{fn}"):
+            return directory  # -- not yet sharded
+        if self._shard == 'hash':
+            d = self.shard_dir(directory, fn)
+            if os.path.exists(f"{d}/{fn}"):
+                return d
+        for d in sorted(self._shards(directory), reverse=True):
+            if os.path.exists(f"{d}/{fn}"):
+                return d
+        return directory
+
+    def _is_sharded(self, directory) -> bool:
+        if not self._shard or not isinstance(directory, str):
+            return False
+        return directory.rstrip('/') in [x.rstrip('/') for x in \
+            (self.INPUT, self.OUTPUT, self.ARCHIVE, self.ERRORED) if x]
+
+    def _newfilename(self, fn, fnum):
+        """
+        Returns <filename>_<fnum>.<ext> (or fn when fnum is 0).
+        """
+        if fnum == 0:
+            return fn
+        if fn.count('.') == 1:
+            nfn, ext = fn.split('.')
+            return f"{nfn}_{fnum}.{ext}"
+        return f"{fn}_{fnum}"
+
+    def _rename(self, src, dst) -> None:
+        """
+        os.rename() with copy+delete fallback across devices.
+        """
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            s = self._copy_file(src, dst, resume=False)
+            if s.code != 200:
+                raise OSError(e.errno, s.message)
+            if os.path.getsize(dst) != os.path.getsize(src):
+                raise OSError(errno.EIO, f"size mismatch after copy: {dst}")
+            os.remove(src)
+        return
+
+    def _scan_shards(self, directory, fn_pattern=None):
+        """
+        Same as _scandir(), fanned out across the shards of a sharded bucket
+        directory (files not yet sharded included).
+        """
+        if not self._is_sharded(directory):
+            yield from self._scandir(directory, fn_pattern)
+            return
+        for f, st in self._scandir(directory, fn_pattern):
+            if not stat.S_ISDIR(st.st_mode):
+                yield f, st
+        for d in self._shards(directory):
+            yield from self._scandir(d, fn_pattern)
+
+    def _scandir(self, directory, fn_pattern=None):
+        """
+        Iterate over directory entries, stat()-ing each matching entry once.
+        :param directory: full path
+        :param fn_pattern: filter based on filename pattern (str or compiled)
+        :return: generator of (DirEntry, stat_result)
+        """
+        rx = re.compile(fn_pattern) if fn_pattern else None
+        with os.scandir(directory) as it:
+            for f in it:
+                if rx and not rx.search(f.name):
+                    continue
+                try:
+                    yield f, f.stat()
+                except OSError:
+                    continue  # -- removed between listing and stat
+
+    def _shards(self, directory) -> list:
+        """
+        Returns leaf shard directories of a sharded bucket directory (or
+        [directory] when not sharded).
+        """
+        if not self._is_sharded(directory):
+            return [directory]
+        r = [directory.rstrip('/')]
+        for _ in range(3 if self._shard == 'date' else 2):
+            t = []
+            for d in r:
+                try:
+                    with os.scandir(d) as it:
+                        t += [f.path for f in it if f.is_dir(follow_symlinks=False)]
+                except OSError:
+                    continue
+            r = t
+        return r
+
     def walk(self, path):
         return self.crawl_dir(path)
 
 
+def _kernel_copy(fd_in, fd_out, offset, size) -> int:
+    """
+    Copy fd_in[offset:size] to fd_out (same offset) in kernel space; falls back
+    to sendfile() then to pread()/write() when not supported.
+    :return: offset reached
+    """
+    fallback = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.EBADF, errno.ENOTSUP)
+    for kind in ['copy_file_range', 'sendfile', 'pread']:
+        try:
+            while offset < size:
+                n = min(CHUNK_SIZE, size - offset)
+                if kind == 'copy_file_range':
+                    n = os.copy_file_range(fd_in, fd_out, n, offset, offset)
+                elif kind == 'sendfile':
+                    os.lseek(fd_out, offset, os.SEEK_SET)
+                    n = os.sendfile(fd_out, fd_in, offset, n)
+                else:
+                    n = os.pwrite(fd_out, os.pread(fd_in, n, offset), offset)
+                if n == 0:
+                    break
+                offset += n
+            return offset
+        except AttributeError:
+            continue  # -- not available on this platform
+        except OSError as e:
+            if e.errno not in fallback:
+                raise
+    return offset
+
+
+@lru_cache(maxsize=4096)
+def _resolve(wd, path) -> str:
+    """
+    Pure-string (memoized) path resolution used by FileManager.fullpath().
+    """
+    r = path
+    if path:
+        if not path.startswith('/'):
+            r = posixpath.join(str(wd), path)
+        if '.' in r.split('/') or '..' in r.split('/'):
+            trailing = r.endswith('/')
+            r = posixpath.normpath(r)
+            if r.startswith('//'):
+                r = r[1:]
+            if trailing and r != '/':
+                r += '/'
+    return r
+
+
+class AsyncFileManager:
+    """
+    asyncio facade for FileManager: mirrors its API (i.e. await afm.move(...))
+    and runs the blocking filesystem calls on a bounded thread pool, so a slow
+    mount doesn't stall the event loop. ls() and crawl() are async iterators.
+    """
+
+    def __init__(self, manager=None, workers=4) -> None:
+        """
+        :param manager: FileManager (default: fm)
+        :param workers: max number of threads
+        """
+        self.fm = manager if manager else fm
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='fm')
+
+    def __getattr__(self, name):
+        attr = getattr(self.fm, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self._run(attr, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False)
+        return
+
+    async def crawl(self, path=None, batch=1000, **kwargs):
+        """
+        Async iterator over iter_tree(), fetched in batches.
+        :param batch: number of entries fetched per executor call
+        :return: async generator of (path, stat)
+        """
+        it = self.fm.iter_tree(path, **kwargs)
+        while True:
+            chunk = await self._run(lambda: list(islice(it, batch)))
+            if not chunk:
+                break
+            for x in chunk:
+                yield x
+
+    async def ls(self, directory=None, fn_pattern=None, fn_only=False, path=None,
+                 ret=None):
+        """
+        Async iterator over ls() results.
+        """
+        r = await self._run(self.fm.ls, directory, fn_pattern, fn_only, path, ret)
+        for x in (r if isinstance(r, list) else [r]):
+            yield x
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._pool, partial(func, *args, **kwargs))
+
+
+class ChecksumIndex:
+    """
+    Content-hash index (persisted per bucket) used to detect files re-dropped
+    under a new name, see FilePipeline(index=...).
+    """
+
+    def __init__(self, manager=None, fn=None, algo='sha256') -> None:
+        """
+        :param manager: FileManager (default: fm)
+        :param fn: index file (default: <pwd>/.index/<bucket>.json)
+        :param algo: hashlib algorithm name
+        """
+        self.fm = manager if manager else fm
+        self.algo = algo
+        self.fn = fn if fn else \
+            f"{self.fm.pwd()}/.index/{self.fm._bucket or 'default'}.json"
+        self.hashes = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved = time.time()
+        self.load()
+
+    def __contains__(self, digest) -> bool:
+        return digest in self.hashes
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def add(self, path, digest=None) -> bool:
+        """
+        Add file to index (atomic check-and-add, also used to reserve a
+        digest before the file is processed, see remove()).
+        :return: False if content was already indexed
+        """
+        digest = digest if digest else self.fm.checksum(path, algo=self.algo)
+        if not digest:
+            return False
+        with self._lock:
+            if digest in self.hashes:
+                return False
+            self.hashes[digest] = os.path.basename(path)
+            self._dirty = True
+        return True
+
+    def check(self, files, directory=None, workers=None) -> tuple[list, list]:
+        """
+        Split files into new and duplicates (hashed in parallel), files that
+        couldn't be read are left out of both.
+        :param files: list [] of filenames
+        :param directory: path
+        :return: [new files], [duplicates]
+        """
+        new, dups, seen = [], [], set()
+        for fn, digest in self.fm.checksums(files, directory, self.algo,
+                                            workers).items():
+            if digest is None:
+                log.error(f"ChecksumIndex.check(): couldn't read {fn}")
+            elif digest in self.hashes or digest in seen:
+                dups += [fn]
+            else:
+                new += [fn]
+                seen.add(digest)
+        return new, dups
+
+    def digest(self, path) -> str:
+        return self.fm.checksum(path, algo=self.algo)
+
+    def flush(self, interval=0) -> None:
+        """
+        save() if the index changed and the last save is older than interval
+        (seconds).
+        """
+        if self._dirty and time.time() - self._saved >= interval:
+            self.save()
+        return
+
+    def load(self) -> None:
+        try:
+            with open(self.fn, 'r') as f:
+                self.hashes = json.load(f)
+        except (OSError, ValueError):
+            self.hashes = {}
+        return
+
+    def remove(self, digest) -> None:
+        """
+        Remove digest from index (i.e. roll back a reservation).
+        """
+        with self._lock:
+            if self.hashes.pop(digest, None) is not None:
+                self._dirty = True
+        return
+
+    def save(self) -> None:
+        """
+        Persist index (atomic replace).
+        """
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        with self._lock:
+            with open(f"{self.fn}.tmp", 'w') as f:
+                json.dump(self.hashes, f)
+            os.replace(f"{self.fn}.tmp", self.fn)
+            self._dirty = False
+            self._saved = time.time()
+        return
+
+
+class FilePipeline:
+    """
+    Drive files through the dir_struct() layout: INPUT -> OUTPUT/ARCHIVE or
+    ERRORED. Files are claimed by an atomic rename into "<INPUT>/.processing/"
+    and only leave it once processed, files left behind by a crashed run are
+    processed again on the next run (at-least-once).
+
+    The processor is called with the full path of the claimed file. It fails
+    when it raises, returns False or returns a Status with code >= 400. With a
+    ChecksumIndex, files whose content was already processed (or is being
+    processed) are skipped (moved to ARCHIVE); the index is saved every
+    save_every seconds while running.
+    """
+
+    def __init__(self, processor, manager=None, workers=4, max_pending=None,
+                 fn_pattern=None, on_success='archive', poll=1.0,
+                 index=None, save_every=5.0) -> None:
+        """
+        :param processor: callable(path)
+        :param manager: FileManager with dir_struct() set (default: fm)
+        :param workers: number of processing threads
+        :param max_pending: max files claimed at once (default: workers*2)
+        :param fn_pattern: only claim filenames matching pattern (regex)
+        :param on_success: 'archive' or 'output'
+        :param poll: seconds between INPUT scans when idle
+        :param index: ChecksumIndex to skip duplicates (optional)
+        :param save_every: seconds between index saves (0: after each file)
+        """
+        self.processor = processor
+        self.fm = manager if manager else fm
+        self.workers = workers
+        self.max_pending = max_pending if max_pending else workers*2
+        self.rx = re.compile(fn_pattern) if fn_pattern else None
+        self.on_success = on_success
+        self.poll = poll
+        self.index = index
+        self.save_every = save_every
+        self._stop = threading.Event()
+
+    def run(self, once=False) -> Status:
+        """
+        Process files until stop() is called.
+        :param once: return as soon as INPUT is drained
+        :return: Status (with "processed", "errored", "skipped" and "failed"
+                 counts, failed: files that couldn't be moved out of
+                 .processing, retried on the next run)
+        """
+        s = Status(204, 'Nothing happened.')
+        cnt = {'processed': 0, 'errored': 0, 'skipped': 0, 'failed': 0}
+        fm = self.fm
+        dst = fm.OUTPUT if self.on_success == 'output' else fm.ARCHIVE
+        if not (fm.INPUT and dst and fm.ERRORED):
+            s.code = 400
+            s.message = 'fm.FilePipeline.run(): directory structure is not set, ' \
+                        'see dir_struct().'
+            log.error(s.message)
+            return s
+        proc = f"{fm.INPUT}/.processing"
+        fm.mkdirs(proc)
+
+        # -- re-queue files claimed by a previous (interrupted) run
+        with os.scandir(proc) as it:
+            claimed = [f.name for f in it if f.is_file()]
+        if claimed:
+            log.info(f"pipeline: recovered {len(claimed)} file(s) from {proc}")
+
+        def settle(_fn, _dst):
+            # -- a file that can't be moved stays in proc (next run retries it)
+            try:
+                if fm.move(_fn, proc, _dst):
+                    return True
+                log.error(f"pipeline: couldn't move {_fn} to {_dst}")
+            except Exception as _e:
+                log.error(f"pipeline: couldn't move {_fn} to {_dst}: {_e}")
+            return False
+
+        def process(_fn):
+            _ok, _digest = False, None
+            if self.index is not None:
+                # -- reserve digest (atomic) before processing
+                _digest = self.index.digest(f"{proc}/{_fn}")
+                if _digest and not self.index.add(f"{proc}/{_fn}", _digest):
+                    log.info(f"pipeline: {_fn} skipped (duplicate content)")
+                    return 'skipped' if settle(_fn, fm.ARCHIVE) else 'failed'
+            try:
+                _res = self.processor(f"{proc}/{_fn}")
+                _ok = not (_res is False or (isinstance(_res, Status) and \
+                    isinstance(_res.code, int) and _res.code >= 400))
+            except Exception as _e:
+                log.error(f"pipeline: {_fn} failed: {_e}")
+            _moved = settle(_fn, dst if _ok else fm.ERRORED)
+            if _digest:
+                if not (_ok and _moved):
+                    self.index.remove(_digest)
+                self.index.flush(self.save_every)
+            if not _moved:
+                return 'failed'
+            return 'processed' if _ok else 'errored'
+
+        def result(_f):
+            try:
+                return _f.result()
+            except Exception as _e:
+                log.error(f"pipeline: {_e}")
+                return 'failed'
+
+        self._stop.clear()
+        inflight = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not self._stop.is_set():
+                # -- backpressure: only claim up to max_pending files
+                room = self.max_pending - len(inflight)
+                if room > 0:
+                    for fn in self._claim(proc, claimed, room):
+                        inflight.add(pool.submit(process, fn))
+                if not inflight:
+                    if once:
+                        break
+                    if self.index is not None:
+                        self.index.flush(self.save_every)
+                    self._stop.wait(self.poll)
+                    continue
+                done, inflight = wait(inflight, timeout=self.poll,
+                                      return_when=FIRST_COMPLETED)
+                for f in done:
+                    cnt[result(f)] += 1
+            for f in inflight:
+                cnt[result(f)] += 1
+
+        if self.index is not None:
+            self.index.flush()
+        s.processed, s.errored, s.skipped, s.failed = cnt.values()
+        if any(cnt.values()):
+            s.code = 200
+            s.message = ', '.join(f"{k}: {v}" for k, v in cnt.items())
+            log.info(f"pipeline: {s.message}")
+        return s
+
+    def stop(self) -> None:
+        """
+        Stop claiming files, run() returns once in-flight files are done.
+        """
+        self._stop.set()
+        return
+
+    def _claim(self, proc, claimed, room):
+        """
+        Returns up to "room" filenames moved (atomically) from INPUT (and its
+        shards) to proc.
+        """
+        r = []
+        while claimed and len(r) < room:
+            r += [claimed.pop(0)]
+        if len(r) >= room:
+            return r
+
+        def entries():
+            if self.fm._is_sharded(self.fm.INPUT):
+                for _f, _ in self.fm._scan_shards(self.fm.INPUT):
+                    yield _f
+            else:
+                with os.scandir(self.fm.INPUT) as _it:
+                    yield from _it
+
+        it = entries()
+        try:
+            for f in it:
+                if f.name.startswith('.') or not f.is_file():
+                    continue
+                if self.rx and not self.rx.search(f.name):
+                    continue
+                if os.path.exists(f"{proc}/{f.name}"):
+                    continue  # -- same name still in-flight
+                try:
+                    os.rename(f.path, f"{proc}/{f.name}")
+                except OSError:
+                    continue  # -- claimed by another worker/process
+                r += [f.name]
+                if len(r) >= room:
+                    break
+        finally:
+            it.close()
+        return r
+
+
+class FileTable:
+    """
+    Compact (columnar) listing: name, size, atime, ctime and mtime are kept in
+    typed arrays instead of one dict per file. Filtering and sorting are
+    vectorized with numpy (when installed) and rows only become dicts when
+    accessed, see FileManager.ls(ret='table').
+    """
+    fields = ('size', 'atime', 'ctime', 'mtime')
+
+    def __init__(self) -> None:
+        self.name = []
+        self.size = array('q')
+        self.atime = array('q')
+        self.ctime = array('q')
+        self.mtime = array('q')
+
+    def __getitem__(self, i) -> dict:
+        return {
+            'filename': self.name[i],
+            'size': self.size[i],
+            'stats': {
+                'atime': self.atime[i],
+                'ctime': self.ctime[i],
+                'mtime': self.mtime[i]}
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self) -> int:
+        return len(self.name)
+
+    def append(self, name, st) -> None:
+        """
+        :param name: filename
+        :param st: os.stat_result
+        """
+        self.name.append(name)
+        self.size.append(st.st_size)
+        self.atime.append(int(st.st_atime))
+        self.ctime.append(int(st.st_ctime))
+        self.mtime.append(int(st.st_mtime))
+        return
+
+    def filter(self, older_than=None, newer_than=None, min_size=None,
+               max_size=None, fn_pattern=None, by='mtime') -> 'FileTable':
+        """
+        Returns rows matching all criteria.
+        :param older_than: age in seconds (or timedelta)
+        :param newer_than: age in seconds (or timedelta)
+        :param min_size: size in bytes (inclusive)
+        :param max_size: size in bytes (inclusive)
+        :param fn_pattern: filter based on filename pattern (regex)
+        :param by: timestamp column used for age: 'atime', 'ctime' or 'mtime'
+        :return: FileTable
+        """
+        now = int(time.time())
+        ts = getattr(self, by)
+        tests = []
+        if older_than is not None:
+            tests += [(ts, '<', now - _seconds(older_than))]
+        if newer_than is not None:
+            tests += [(ts, '>', now - _seconds(newer_than))]
+        if min_size is not None:
+            tests += [(self.size, '>=', min_size)]
+        if max_size is not None:
+            tests += [(self.size, '<=', max_size)]
+
+        if np is not None:
+            mask = np.ones(len(self), dtype=bool)
+            for col, op, v in tests:
+                c = np.frombuffer(col, dtype=np.int64)
+                mask &= c < v if op == '<' else c > v if op == '>' else \
+                    c >= v if op == '>=' else c <= v
+            idx = np.flatnonzero(mask)
+        else:
+            ops = {'<': lambda a, b: a < b, '>': lambda a, b: a > b,
+                   '>=': lambda a, b: a >= b, '<=': lambda a, b: a <= b}
+            idx = [i for i in range(len(self)) if \
+                   all(ops[op](col[i], v) for col, op, v in tests)]
+        if fn_pattern:
+            rx = re.compile(fn_pattern)
+            idx = [i for i in idx if rx.search(self.name[i])]
+        return self._take(idx)
+
+    def sort(self, by='mtime', reverse=False) -> 'FileTable':
+        """
+        Returns rows sorted by column ('filename', 'size', 'atime', 'ctime' or
+        'mtime').
+        """
+        if by == 'filename':
+            idx = sorted(range(len(self)), key=self.name.__getitem__)
+        elif np is not None:
+            idx = np.argsort(np.frombuffer(getattr(self, by), dtype=np.int64),
+                             kind='stable')
+        else:
+            idx = sorted(range(len(self)), key=getattr(self, by).__getitem__)
+        return self._take(idx[::-1] if reverse else idx)
+
+    def to_dict(self) -> list:
+        return list(self)
+
+    def to_list(self) -> list:
+        """
+        Returns list of [ctime, filename] (same as ls(ret='list')).
+        """
+        return [[c, n] for c, n in zip(self.ctime, self.name)]
+
+    def _take(self, idx) -> 'FileTable':
+        r = FileTable()
+        r.name = [self.name[i] for i in idx]
+        for f in self.fields:
+            col = getattr(self, f)
+            if np is not None and len(col):
+                col = np.frombuffer(col, dtype=np.int64)
+                setattr(r, f, array('q', col[np.asarray(idx, dtype=np.intp)].tobytes()))
+            else:
+                setattr(r, f, array('q', (col[i] for i in idx)))
+        return r
+
+
+def _seconds(v) -> int:
+    return int(v.total_seconds()) if isinstance(v, timedelta) else int(v)
+
+
 fm = FileManager()
@@ -3,13 +3,13 @@ Library to quickly/easily connect to MongoDB and using CRUD functionalities
 in a frictionless way.
 """
 __authors__ = ['randollrr']
-__version__ = '1.4.0'
+__version__ = '1.5.0'
 
 from copy import deepcopy
 import os
 from uuid import uuid4
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
 from pymongo.cursor import Cursor
 from pymongo.database import Collection, Database
 from pymongo.errors import ServerSelectionTimeoutError
@@ -352,6 +352,92 @@ class MongoCRUD:
             m = 'delete(): Server Error: {}'.format(e)
         return self._response(r, c, m)
 
+    def delete_many(self, where=None, collection=None, db=None):
+        """
+        Remove all documents matching filter in a single request.
+        :param where: filter object, None or {} to remove every document (truncate)
+        :param collection: to change collection/table
+        :param db: to change database
+        """
+        self.cd(collection, db)
+        r = []
+        c = 204
+        m = 'Nothing happened.'
+
+        log.debug('delete_many docs like: {}'.format(where))
+        try:
+            statement = self._encode_objectid(where) if where else {}
+            obj = self.collection.delete_many(statement)
+            log.info('delete_count: {}, delete_ack: {}'.format(obj.deleted_count, obj.acknowledged))
+            r += [{'statement': where or {}, 'delete_count': obj.deleted_count, 'delete_ack': obj.acknowledged}]
+            c = 200
+            m = 'Items deletion have been executed.'
+        except Exception as e:
+            r = where
+            c = 500
+            m = 'delete_many(): Server Error: {}'.format(e)
+        return self._response(r, c, m)
+
+    def rename(self, new_name, collection=None, db=None, drop_target=True):
+        """
+        Rename collection (i.e. swap a staging collection in place).
+        :param new_name: new collection name
+        :param collection: collection to rename
+        :param db: to change database
+        :param drop_target: replace new_name if it already exists
+        """
+        self.cd(collection, db)
+        r = []
+        c = 204
+        m = 'Nothing happened.'
+
+        try:
+            self.collection.rename(new_name, dropTarget=drop_target)
+            log.info('renamed: {} to {}'.format(self.collection.name, new_name))
+            r += [new_name]
+            c = 200
+            m = 'Collection renamed.'
+            self.cd(new_name, db)
+        except Exception as e:
+            c = 500
+            m = 'rename(): Server Error: {}'.format(e)
+        return self._response(r, c, m)
+
+    def upsert(self, doc=None, key=None, collection=None, db=None, add_ts=True):
+        """
+        Insert or replace objects matching on a (natural) key, in one bulk request.
+        :param doc: object or list of objects
+        :param key: field name or list of field names identifying an object
+        :param collection: to change collection/table
+        :param db: to change database
+        """
+        self.cd(collection, db)
+        r = None
+        c = 204
+        m = 'Nothing happened.'
+
+        keys = [key] if isinstance(key, str) else key
+        data = [doc] if isinstance(doc, dict) else doc
+        try:
+            if keys and data:
+                ops = []
+                for d in data:
+                    d = dict(d)
+                    if add_ts:
+                        d['updated_dt'] = ts()
+                    ops += [ReplaceOne({k: d.get(k) for k in keys}, d, upsert=True)]
+                res = self.collection.bulk_write(ops, ordered=False)
+                r = {'matched': res.matched_count, 'modified': res.modified_count,
+                     'upserted': res.upserted_count}
+                c = 200
+                m = 'Data upserted.'
+                log.info('upsert_match_count: {}, upsert_mod: {}, upsert_count: {}'.format(
+                    res.matched_count, res.modified_count, res.upserted_count))
+        except Exception as e:
+            c = 500
+            m = 'upsert(): Server Error: {}'.format(e)
+        return self._response(r, c, m)
+
 
     def _decode_objectid(self, o):
         r = o
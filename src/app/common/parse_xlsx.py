@@ -1,26 +1,64 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import csv
 from datetime import datetime
+from functools import lru_cache
+from glob import glob
+import hashlib
 import json
+import os
+import pickle
 
+from openpyxl import load_workbook
 import pandas as pd
 
-from common.utils import deprecated, log
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from common.fm import fm
+from common.utils import deprecated, log, Status
 from common.mongo import dao
 
-__version__ = '0.2.3'
+__version__ = '0.9.0'
+
+BOOL_VALUES = {
+    'true': True, 't': True, 'yes': True, 'y': True, '1': True, 'on': True,
+    'false': False, 'f': False, 'no': False, 'n': False, '0': False, 'off': False}
+DATE_FORMATS = ['%m/%d/%Y', '%b %d, %Y']
+EXPORT_FORMATS = {
+    '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv',
+    '.parquet': 'parquet', '.pq': 'parquet',
+    '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
 
 
 class XlsxDataCollector:
 
-    def __init__(self, filename, sheetname=None, transformer=None, auto_parse=True):
+    def __init__(self, filename, sheetname=None, transformer=None, auto_parse=True,
+                 cache=None):
+        """
+        :param filename: xlsx file path
+        :param sheetname: sheet name or index (default: first sheet)
+        :param transformer: see transform()
+        :param auto_parse: read file and sheet on init
+        :param cache: directory where parsed sheets are cached, keyed on file
+                      content hash + sheet + transformer + headers
+                      (True: <pwd>/.cache/xlsx)
+        """
         self.data = []
         self.filename = filename
         self.xls_file = None
         self.sheetname = sheetname
         self.transformer = transformer if isinstance(transformer, dict) else None
+        self.date_stats = {}
+        self.cache = f"{fm.pwd()}/.cache/xlsx" if cache is True else cache
 
-        # -- read file and parse
+        # -- read file and parse (w/ cache, the file is opened on a cache miss)
         if auto_parse:
-            self.read_file()
+            if not self.cache:
+                self.read_file()
             self.read_sheet()
             self.parse()
         return
@@ -53,36 +91,87 @@ class XlsxDataCollector:
         elif sheetname:
             self.sheetname = sheetname
 
+        key = self._cache_key(headers, sort_by) \
+            if self.cache and ret == 'dict' else None
+        if key:
+            cached = self._cache_load(key)
+            if cached is not None:
+                self.data = cached
+                return self.data
+            if not self.xls_file:
+                self.read_file()
+
         if self.xls_file:
             try:
-                list_cols = None
-                if self.transformer:
-                    list_cols = self.transformer.keys()
                 df = pd.read_excel(
                     self.xls_file,
                     sheet_name=self.sheetname,
-                    usecols=list_cols,
+                    usecols=self._usecols(),
                     header=headers)
                 if sort_by:
                     df = df.sort_values(by=sort_by)
-                data = df.fillna('').to_dict('records')
-
-                self.data = []
-                for d in data:
-                    t_rec = {}
-                    for k in d:
-                        if self.transformer:
-                            t_rec.update({self.transformer[k]: d[k]})
-                        else:
-                            t_rec.update({k: d[k]})
-                    self.data += [t_rec]
+                self.data = self.transform(df).to_dict('records')
                 r = df if ret == 'df' else self.data
-                del df, data
+                del df
+                if key:
+                    self._cache_save(key, self.data)
             except Exception as e:
                 self.data = []
                 log.error(f"Parsing issues (w/ Pandas) encountered.\n {e}")
         return r
 
+    def iter_sheet(self, sheetname=None, batch_size=1000, headers=0):
+        """
+        Stream sheet records in batches (openpyxl read-only mode), memory use
+        stays constant regardless of the sheet size. Values come straight from
+        openpyxl so records differ from read_sheet(): fully blank rows are
+        skipped, ints are not widened to floats by missing cells and duplicate
+        headers are not renamed (pandas would add a '.1' suffix).
+        :param sheetname: sheet name or index (default: first sheet)
+        :param batch_size: number of records per batch
+        :param headers: row index of the header row
+        :return: generator of [<dict>]
+        """
+        if not sheetname and not self.sheetname:
+            self.sheetname = 0
+        elif sheetname:
+            self.sheetname = sheetname
+
+        wb = load_workbook(self.filename, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[self.sheetname] \
+                if isinstance(self.sheetname, int) else wb[self.sheetname]
+            rows = ws.iter_rows(values_only=True)
+            for _ in range(headers):
+                next(rows, None)
+            cols = next(rows, None)
+            if cols is None:
+                return
+
+            # -- index and name of columns to keep
+            usecols = self._usecols()
+            idx, names = [], []
+            for i, c in enumerate(cols):
+                c = f"Unnamed: {i}" if c is None else c
+                if usecols is None or c in usecols:
+                    idx += [i]
+                    names += [c]
+
+            batch = []
+            for row in rows:
+                if not any(v is not None for v in row):
+                    continue
+                batch += [[row[i] if i < len(row) else None for i in idx]]
+                if len(batch) >= batch_size:
+                    yield self.transform(
+                        pd.DataFrame(batch, columns=names)).to_dict('records')
+                    batch = []
+            if batch:
+                yield self.transform(
+                    pd.DataFrame(batch, columns=names)).to_dict('records')
+        finally:
+            wb.close()
+
     def parse(self):
         pass
 
@@ -92,45 +181,615 @@ class XlsxDataCollector:
         return self.save_to_db(data=data, collection=collection,
                                truncate=truncate, where=where)
 
-    def save_to_db(self, data=None, collection=None, truncate=False, where={}):
+    def save_to_db(self, data=None, collection=None, truncate=False, where={},
+                   batch_size=None, key=None):
+        """
+        Save records in batches. When data is a generator of batches (i.e.
+        iter_sheet()), the next batch is parsed while the previous one is being
+        written.
+        :param data: list of records or iterable of batches (default: self.data)
+        :param collection: default: 'parsed_xlsx_data'
+        :param truncate: True to delete_many(where) first, or 'swap' to load a
+                         staging collection then rename it over collection
+        :param where: filter used by truncate=True
+        :param batch_size: records per request (default: 5000)
+        :param key: natural key field(s), upsert records instead of insert
+        :return: response object (status.docs: number of records written)
+        """
         r = None
         if not data:
             data = self.data
         if not collection:
             collection = 'parsed_xlsx_data'
+        if not batch_size:
+            batch_size = 5000
         if data:
-            if truncate:
-                dao.delete(
-                    dao.read(where=where, collection=collection)['data'],
-                    collection=collection)
-            r = dao.create(data, collection)
+            target = collection
+            if truncate == 'swap':
+                target = f"{collection}_staging"
+                dao.delete_many({}, collection=target)
+            elif truncate:
+                dao.delete_many(where, collection=collection)
+
+            def write(_batch):
+                if key:
+                    return dao.upsert(_batch, key=key, collection=target)
+                return dao.create(_batch, target)
+
+            r = {'status': {'code': 204, 'message': 'Nothing happened.', 'docs': 0},
+                 'data': []}
+            pending = None
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                for batch in _batches(data, batch_size):
+                    if pending:
+                        self._save_status(r, pending)
+                    pending = (pool.submit(write, batch), len(batch))
+                if pending:
+                    self._save_status(r, pending)
+
+            if truncate == 'swap' and r['status']['code'] == 200:
+                res = dao.rename(collection, collection=target)
+                if res['status']['code'] != 200:
+                    r['status'] = res['status']
+            log.info(f"save_to_db: {r['status']}")
         return r
 
     def to_date(self, dt):
-        r = dt
-        try:
-            r = datetime.strftime(datetime.strptime(dt, '%m/%d/%Y'), '%Y-%m-%d')
-        except:
-            try:
-                r = datetime.strftime(datetime.strptime(dt.replace('PST', '')
-                        .replace('PDT', '')
-                        .replace('\t', '')
-                        .strip(),
-                        '%b %d, %Y'),
-                    '%Y-%m-%d')
-            except:
-                pass
+        """
+        Returns dt as '%Y-%m-%d' (or dt if it can't be parsed). Results are
+        memoized, repeated values don't go through strptime() again.
+        """
+        return _to_date(dt) if isinstance(dt, str) else dt
+
+    def to_dates(self, col, fmt=None):
+        """
+        Column-wise (vectorized) to_date(): each distinct value is parsed once,
+        with fmt or with the formats known by to_date() ordered by how well
+        they match a sample of the column. Returns '%Y-%m-%d' strings,
+        unparseable values are left as-is and counted in self.date_stats.
+        :param col: pandas Series (or list)
+        :param fmt: strptime format
+        :return: pandas Series
+        """
+        col = pd.Series(col)
+        if pd.api.types.is_datetime64_any_dtype(col):
+            return col.dt.strftime('%Y-%m-%d').where(col.notna(), col)
+
+        values = col.dropna()
+        uniq = pd.Series(values.unique(), dtype=object)
+        d = pd.Series(pd.NaT, index=uniq.index, dtype='datetime64[ns]')
+        is_dt = uniq.map(lambda v: isinstance(v, datetime)).astype(bool)
+        if is_dt.any():
+            d[is_dt] = pd.to_datetime(uniq[is_dt])
+        txt = uniq.astype(str).str.replace(r'PST|PDT|\t', '', regex=True).str.strip()
+        for f in ([fmt] if fmt else _infer_formats(txt[~is_dt])):
+            todo = d.isna()
+            if not todo.any():
+                break
+            d[todo] = pd.to_datetime(txt[todo], format=f, errors='coerce')
+
+        mapped = col.map(dict(zip(uniq, d.dt.strftime('%Y-%m-%d'))))
+        r = mapped.where(mapped.notna(), col)
+
+        # -- report unparseable values
+        unparsed = int((mapped.isna() & col.notna()).sum())
+        self.date_stats[col.name] = {
+            'total': len(values),
+            'unparsed': unparsed,
+            'ratio': round(unparsed / len(values), 4) if len(values) else 0.0}
+        if unparsed:
+            log.warn(f"to_dates(): {col.name}: {unparsed}/{len(values)} value(s) "
+                     f"could not be parsed.")
         return r
 
     def to_dict(self):
         return self.data
 
+    def to_file(self, fn, fmt=None, data=None, batch_size=None) -> Status:
+        """
+        Export records to a file, one batch at a time: memory use is bound by
+        batch_size when data is a generator of batches (i.e. iter_sheet()).
+        The file is written to "<fn>.part" and renamed when complete.
+        Formats: 'ndjson', 'csv', 'parquet' and 'arrow' (IPC/Feather v2), the
+        last two require pyarrow (columns are typed from the first batch and
+        widened when a later batch doesn't fit: int -> float, otherwise
+        string; '' is written as null).
+        :param fn: output file path
+        :param fmt: default: from fn extension (.ndjson|.jsonl|.csv|.parquet|.arrow)
+        :param data: list of records or iterable of batches (default: self.data)
+        :param batch_size: records per write / parquet row group (default: 5000)
+        :return: Status (with "records" count and "file")
+        """
+        s = Status(204, 'Nothing happened.')
+        s.records, s.file = 0, fn
+        if data is None:
+            data = self.data
+        if not fmt:
+            fmt = EXPORT_FORMATS.get(os.path.splitext(fn)[1].lower())
+        if not batch_size:
+            batch_size = 5000
+
+        if fmt not in EXPORT_FORMATS.values():
+            s.code, s.message = 400, f"Unsupported export format: {fmt}"
+        elif fmt in ['parquet', 'arrow'] and pa is None:
+            s.code, s.message = 400, f"pyarrow is required for {fmt} export."
+        if s.code == 400:
+            log.error(f"to_file(): {s.message}")
+            return s
+
+        tmp = f"{fn}.part"
+        try:
+            if fmt in ['parquet', 'arrow']:
+                writer = _ArrowWriter(tmp, fmt)
+                try:
+                    for batch in _batches(data, batch_size):
+                        writer.write(batch)
+                        s.records += len(batch)
+                finally:
+                    writer.close()
+            else:
+                with open(tmp, 'w', **({'newline': ''} if fmt == 'csv' else {})) as f:
+                    writer = None
+                    for batch in _batches(data, batch_size):
+                        if fmt == 'ndjson':
+                            f.write(''.join(json.dumps(rec, default=str) + '\n' \
+                                            for rec in batch))
+                        else:
+                            if not writer:
+                                writer = csv.DictWriter(f, fieldnames=list(batch[0]),
+                                                        restval='', extrasaction='ignore')
+                                writer.writeheader()
+                            writer.writerows(batch)
+                        s.records += len(batch)
+            os.replace(tmp, fn)
+            s.code, s.message = 200, f"exported: {s.records} record(s) to {fn}"
+            log.info(s.message)
+        except Exception as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            s.code, s.message = 500, f"to_file(): {fn}: {e}"
+            log.error(s.message)
+        return s
+
     def to_json(self):
         r = None
         if self.data:
             r = json.dumps(self.data)
         return r
 
+    def transform(self, df):
+        """
+        Apply transformer to a DataFrame, column-wise. Transformer values are
+        either the new column name or a spec:
+            {'name': <new name>, 'type': 'str|int|float|bool|date|datetime',
+             'format': <strptime format>, 'default': <fill value>}
+        or a computed column (key is the new column name, applied last):
+            {'compute': lambda df: df['qty'] * df['price']}
+        bool strings are read with BOOL_VALUES (i.e. 'no', '0' -> False),
+        other strings are missing ('' or default).
+        :param df: DataFrame (as read from the sheet)
+        :return: DataFrame (renamed, typed, fillna(''))
+        """
+        if not self.transformer:
+            return self._fillna(df)
+
+        names, specs, computed = {}, {}, {}
+        for k, v in self.transformer.items():
+            if isinstance(v, dict):
+                if 'compute' in v:
+                    computed[k] = v['compute']
+                    continue
+                names[k] = v.get('name', k)
+                specs[names[k]] = v
+            else:
+                names[k] = v
+        df = df.rename(columns=names)
+        for c, spec in specs.items():
+            if c in df:
+                df[c] = self._coerce(df[c], spec)
+        for c, func in computed.items():
+            df[c] = func(df)
+        return self._fillna(df)
+
+    def _cache_key(self, headers=0, sort_by=None):
+        """
+        Returns cache key of the current sheet: hash of file content, sheet,
+        transformer, headers and sort_by (None if the file can't be read).
+        """
+        digest = fm.checksum(os.path.abspath(self.filename))
+        if not digest:
+            return None
+        spec = json.dumps([digest, self.sheetname, self.transformer, headers,
+                           sort_by, __version__], sort_keys=True, default=_func_key)
+        return hashlib.sha256(spec.encode()).hexdigest()
+
+    def _cache_load(self, key):
+        """
+        Returns cached records (None on a cache miss).
+        """
+        r = None
+        fn = f"{self.cache}/{key}.pkl"
+        if os.path.exists(fn):
+            try:
+                with open(fn, 'rb') as f:
+                    r = pickle.load(f)
+                log.info(f"parsed data loaded from cache: {fn}")
+            except Exception as e:
+                log.warn(f"cache file couldn't be loaded ({fn}): {e}")
+        return r
+
+    def _cache_save(self, key, data):
+        """
+        Save records to cache (pickle protocol 5, written to .part then renamed).
+        """
+        fn = f"{self.cache}/{key}.pkl"
+        try:
+            os.makedirs(self.cache, exist_ok=True)
+            with open(f"{fn}.part", 'wb') as f:
+                pickle.dump(data, f, protocol=5)
+            os.replace(f"{fn}.part", fn)
+        except Exception as e:
+            log.warn(f"parsed data couldn't be cached ({fn}): {e}")
+
+    def _coerce(self, col, spec):
+        kind = spec.get('type')
+        if kind == 'date':
+            col = self.to_dates(col, fmt=spec.get('format'))
+        elif kind == 'datetime':
+            col = pd.to_datetime(col, format=spec.get('format'), errors='coerce')
+        elif kind in ['int', 'float']:
+            col = pd.to_numeric(col, errors='coerce')
+            if kind == 'int':
+                col = col.round().astype('Int64')
+        elif kind == 'str':
+            col = col.where(col.isna(), col.astype(str))
+        elif kind == 'bool':
+            col = col.map(_to_bool)
+        if 'default' in spec:
+            col = col.fillna(spec['default'])
+        return col
+
+    def _fillna(self, df):
+        """
+        Fill missing values with ''. Typed columns (Int64, datetime, bool)
+        can't hold '' so those with missing values are cast to object first.
+        """
+        cols = [i for i, t in enumerate(df.dtypes) \
+                if t != object and df.iloc[:, i].hasnans]
+        if cols:
+            df = df.copy()
+            for i in cols:  # -- by position, headers may repeat (iter_sheet)
+                df.isetitem(i, df.iloc[:, i].astype(object))
+        return df.fillna('')
+
+    def _save_status(self, r, pending):
+        """
+        Merge the response of one batch into r.
+        """
+        job, count = pending
+        res = job.result()
+        if res['status']['code'] == 200 and r['status']['code'] in [200, 204]:
+            r['status'] = {'code': 200, 'message': 'OK',
+                           'docs': r['status']['docs'] + count}
+        elif res['status']['code'] != 200:
+            r['status'] = dict(res['status'], docs=r['status']['docs'])
+        return
+
+    def _usecols(self):
+        """
+        Returns sheet columns referenced by transformer (None: all columns).
+        """
+        if not self.transformer:
+            return None
+        return [k for k, v in self.transformer.items() \
+                if not (isinstance(v, dict) and 'compute' in v)]
+
+
+class XlsxBatchCollector:
+    """
+    Parse many workbooks (all or selected sheets) across a process pool and
+    stream each workbook's records to a sink as soon as it's parsed. A file
+    that fails to parse is moved to "errored" (default: fm.ERRORED) without
+    stopping the batch.
+    Note: transformer is sent to worker processes, computed columns must be
+    picklable (module-level functions, not lambdas), run() fails early
+    otherwise.
+    """
+
+    def __init__(self, files, sheets=None, transformer=None, headers=0,
+                 sink=None, errored=None, workers=None, cache=None):
+        """
+        :param files: list [] of paths, a directory or a glob pattern
+                      (i.e. "/data/input/*.xlsx")
+        :param sheets: list [] of sheet names/indexes (default: all sheets)
+        :param transformer: see XlsxDataCollector.transform()
+        :param headers: row index of the header row
+        :param sink: callable(filename, sheetname, records)
+                     (default: collect in self.data)
+        :param errored: directory where files that failed are moved
+                        (default: fm.ERRORED if set)
+        :param workers: number of processes (default: cpu count)
+        :param cache: parsed sheets cache directory, see XlsxDataCollector
+        """
+        self.data = {}
+        self.files = files
+        self.sheets = sheets
+        self.transformer = transformer if isinstance(transformer, dict) else None
+        self.headers = headers
+        self.sink = sink if sink else self._collect
+        self.errored = errored
+        self.workers = workers
+        self.cache = cache
+
+    def get_files(self) -> list:
+        r = self.files
+        if isinstance(self.files, str):
+            if os.path.isdir(self.files):
+                r = sorted(glob(os.path.join(self.files, '*.xlsx')))
+            else:
+                r = sorted(glob(self.files))
+        return r if isinstance(r, list) else []
+
+    def run(self) -> Status:
+        """
+        Parse all files.
+        :return: Status (with "files", "sheets", "records" counts, "errored"
+                 list of files that failed to parse and "failed" list of files
+                 the sink failed on)
+        """
+        s = Status(204, 'Nothing happened.')
+        s.files, s.sheets, s.records, s.errored, s.failed = 0, 0, 0, [], []
+        files = self.get_files()
+        if not files:
+            return s
+        try:
+            pickle.dumps(self.transformer)
+        except Exception as e:
+            s.code, s.message = 400, f"transformer is not picklable: {e}"
+            log.error(f"XlsxBatchCollector: {s.message}")
+            return s
+
+        errored = self.errored if self.errored else fm.ERRORED
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            jobs = {pool.submit(_parse_workbook, f, self.sheets, self.transformer,
+                                self.headers, self.cache): f for f in files}
+            for job in as_completed(jobs):
+                f = jobs[job]
+                try:
+                    res = job.result()
+                except Exception as e:
+                    log.error(f"XlsxBatchCollector: {f} failed: {e}")
+                    s.errored += [f]
+                    if errored:
+                        self._move_errored(f, errored)
+                    continue
+                # -- sink errors: the workbook is fine, it isn't moved
+                try:
+                    for sheet, records in res:
+                        self.sink(f, sheet, records)
+                        s.sheets += 1
+                        s.records += len(records)
+                    s.files += 1
+                except Exception as e:
+                    log.error(f"XlsxBatchCollector: {f} sink failed: {e}")
+                    s.failed += [f]
+
+        s.code = 200 if s.files else 500
+        s.message = f"parsed: {s.files} file(s), {s.sheets} sheet(s), " \
+                    f"{s.records} record(s), errored: {len(s.errored)}, " \
+                    f"sink failed: {len(s.failed)}"
+        log.info(s.message)
+        return s
+
+    def _collect(self, filename, sheetname, records):
+        self.data.setdefault(filename, {})[sheetname] = records
+
+    def _move_errored(self, filename, errored):
+        path = os.path.abspath(filename)
+        try:
+            if not fm.move(os.path.basename(path), os.path.dirname(path), errored):
+                log.error(f"XlsxBatchCollector: couldn't move {path} to {errored}")
+        except Exception as e:
+            log.error(f"XlsxBatchCollector: couldn't move {path} to {errored}: {e}")
+
+
+class _ArrowWriter:
+    """
+    Streaming parquet/arrow (IPC) file writer, see XlsxDataCollector.to_file().
+    The schema comes from the first batch; a batch that doesn't fit widens it
+    and what was already written is read back and rewritten with the wider
+    schema.
+    """
+
+    def __init__(self, fn, fmt) -> None:
+        self.fn = fn
+        self.fmt = fmt
+        self.schema = None
+        self.writer = None
+
+    def close(self) -> None:
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        elif not os.path.exists(self.fn):
+            open(self.fn, 'wb').close()  # -- no records
+        return
+
+    def write(self, records) -> None:
+        if self.schema is None:
+            table = _arrow_table(records)
+            self.schema = table.schema
+        else:
+            try:
+                table = _arrow_table(records, self.schema)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError):
+                schema = _arrow_widen(self.schema, _arrow_table(records).schema)
+                if schema == self.schema:
+                    raise
+                self._rewrite(schema)
+                table = _arrow_table(records, self.schema)
+        if not self.writer:
+            self.writer = self._open()
+        self.writer.write_table(table)
+        return
+
+    def _open(self):
+        return pq.ParquetWriter(self.fn, self.schema) if self.fmt == 'parquet' \
+            else pa.ipc.new_file(self.fn, self.schema)
+
+    def _rewrite(self, schema) -> None:
+        """
+        Rewrite the records written so far with a wider schema.
+        """
+        log.info(f"to_file(): {self.fn}: widening schema to {schema}")
+        self.writer.close()
+        if self.fmt == 'parquet':
+            table = pq.read_table(self.fn)
+        else:
+            with pa.OSFile(self.fn) as src:
+                table = pa.ipc.open_file(src).read_all()
+        self.schema = schema
+        self.writer = self._open()
+        self.writer.write_table(table.cast(schema))
+        del table
+        return
+
+
+def _arrow_table(records, schema=None):
+    """
+    Records to a pyarrow Table ('' as null). Without schema, mixed-type
+    columns are written as strings and all-null columns typed as string; with
+    schema, values of string fields are converted to str.
+    """
+    df = pd.DataFrame(records)
+    df = df.mask(df.astype(object) == '')
+    if schema is None:
+        try:
+            t = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df = df.apply(lambda c: c.where(c.isna(), c.astype(str)) \
+                          if c.dtype == object else c)
+            t = pa.Table.from_pandas(df, preserve_index=False)
+        schema = pa.schema([pa.field(f.name, pa.string()) \
+                            if pa.types.is_null(f.type) else f for f in t.schema])
+        return t.cast(schema)
+
+    for field in schema:
+        if field.name in df and (pa.types.is_string(field.type) or
+                                 pa.types.is_large_string(field.type)):
+            c = df[field.name].astype(object)
+            df[field.name] = c.where(c.isna(), c.astype(str))
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def _arrow_widen(schema, other):
+    """
+    Returns schema with fields widened to also hold the types of other:
+    int -> int64 or float64 (when either is a float), otherwise string.
+    """
+    fields = []
+    for f in schema:
+        t = other.field(f.name).type if f.name in other.names else None
+        if t is None or t == f.type or pa.types.is_null(t):
+            fields += [f]
+        elif pa.types.is_integer(f.type) and pa.types.is_integer(t):
+            fields += [pa.field(f.name, pa.int64())]
+        elif (pa.types.is_integer(f.type) or pa.types.is_floating(f.type)) and \
+                (pa.types.is_integer(t) or pa.types.is_floating(t)):
+            fields += [pa.field(f.name, pa.float64())]
+        else:
+            fields += [pa.field(f.name, pa.string())]
+    return pa.schema(fields)
+
+
+def _batches(data, size):
+    """
+    Regroup records (or batches of records) into lists of size records.
+    """
+    batch = []
+    for item in data:
+        for rec in (item if isinstance(item, list) else [item]):
+            batch += [rec]
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _func_key(func) -> str:
+    """
+    Cache key of a callable (computed column): name and bytecode hash.
+    """
+    code = getattr(func, '__code__', None)
+    h = hashlib.sha256(code.co_code + repr(code.co_consts).encode()).hexdigest() \
+        if code else ''
+    return f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', func)}:{h}"
+
+
+def _infer_formats(txt, sample=200) -> list:
+    """
+    Returns DATE_FORMATS ordered by number of matches on a sample of txt.
+    """
+    txt = txt.head(sample)
+    hits = {f: int(pd.to_datetime(txt, format=f, errors='coerce').notna().sum()) \
+            for f in DATE_FORMATS}
+    return sorted(DATE_FORMATS, key=lambda f: -hits[f])
+
+
+def _parse_workbook(filename, sheets=None, transformer=None, headers=0,
+                    cache=None) -> list:
+    """
+    Worker (process pool): returns [(sheetname, records)] of a workbook.
+    """
+    r = []
+    xdc = XlsxDataCollector(filename, transformer=transformer, auto_parse=False,
+                            cache=cache)
+    if not (cache and sheets):  # -- w/ cache, opened on a cache miss
+        xdc.read_file()
+        if not xdc.xls_file:
+            raise ValueError('Excel (xlsx) file is expected.')
+    for sheet in (sheets if sheets else xdc.xls_file.sheet_names):
+        records = xdc.read_sheet(sheet, headers=headers)
+        if records is None:
+            raise ValueError(f"couldn't parse sheet: {sheet}")
+        r += [(sheet, records)]
+    if xdc.xls_file:
+        xdc.xls_file.close()
+    return r
+
+
+@lru_cache(maxsize=65536)
+def _to_bool(v):
+    """
+    Returns True/False for bools, numbers and strings of BOOL_VALUES
+    (case-insensitive), None otherwise.
+    """
+    if pd.api.types.is_bool(v):
+        return bool(v)
+    if pd.api.types.is_number(v):
+        return None if pd.isna(v) else bool(v)
+    if isinstance(v, str):
+        return BOOL_VALUES.get(v.strip().lower())
+    return None
+
+
+def _to_date(dt) -> str:
+    r = dt
+    try:
+        r = datetime.strftime(datetime.strptime(dt, '%m/%d/%Y'), '%Y-%m-%d')
+    except:
+        try:
+            r = datetime.strftime(datetime.strptime(dt.replace('PST', '')
+                    .replace('PDT', '')
+                    .replace('\t', '')
+                    .strip(),
+                    '%b %d, %Y'),
+                '%Y-%m-%d')
+        except:
+            pass
+    return r
+
 
 # CHANGELOG
 # v0.1.0 Initial implementation
@@ -140,3 +799,14 @@ class XlsxDataCollector:
 # v0.2.1 added support for auto_parse=true|false in constructor (default: True)
 # v0.2.2 added support for read_sheet() to return parsed dict or the df (DataFrame)
 # v0.2.3 bugfix: return var used before assigned
+# v0.3.0 added iter_sheet() to stream record batches (openpyxl read-only mode)
+# v0.4.0 transformer applied column-wise (transform()), supports type coercion,
+#        date formats, defaults and computed columns
+# v0.5.0 added XlsxBatchCollector: parse many workbooks/sheets on a process pool
+# v0.6.0 save_to_db() writes in batches (pipelined w/ parsing), fast truncate
+#        (delete_many or staging collection swap) and upserts on a natural key
+# v0.7.0 to_date() memoized, to_dates() parses distinct values once, infers
+#        format order per column and reports unparseable values (date_stats)
+# v0.8.0 added to_file(): streaming export to NDJSON, CSV, Parquet and Arrow IPC
+# v0.9.0 added parsed sheet cache (cache=), keyed on file content hash + sheet +
+#        transformer + headers
@@ -1,7 +1,11 @@
+import asyncio
 import json
+import threading
+
 import pytest
+from elasticsearch import Elasticsearch
 
-from common.elastic import ElasticCRUD, ts_range
+from common.elastic import AsyncElasticCRUD, ElasticCRUD, ts_range
 # from connectors import device_querier as dq
 
 @pytest.mark.parametrize('inp, out', [
@@ -57,3 +61,286 @@ def test_read_index_latest(i, o):
     res = dao.read(i, metadata=True, limit=100)
     print(json.dumps(res, indent=4))
     assert len(res) > o
+
+
+class FakeResponse(dict):
+    @property
+    def body(self):
+        return self
+
+
+class FakeClient:
+    """
+    Minimal Elasticsearch client: serves self.docs to PIT/search_after and
+    sliced scroll requests (hits sorted by position).
+    """
+    def __init__(self, n=0):
+        self.docs = [{'n': i, 'host': f"r{i % 3}"} for i in range(n)]
+        self.calls = []
+        self.scrolls = {}
+
+    def _hits(self, docs, start, size):
+        return FakeResponse({'hits': {'total': {'value': len(docs), 'relation': 'eq'},
+                         'hits': [{'_index': 'logs', '_id': str(i), '_source': dict(d),
+                                   'sort': [i]} for i, d in docs[start:start+size]]}})
+
+    def _aggs(self, aggs):
+        def metrics(docs, _aggs):
+            return {k: {'value': sum(d[v['sum']['field']] for d in docs)} \
+                    for k, v in _aggs.items()}
+
+        if 'groupby' not in aggs:
+            return FakeResponse({'hits': {'total': {'value': len(self.docs)}},
+                                 'aggregations': metrics(self.docs, aggs)})
+        comp = aggs['groupby']['composite']
+        fields = [list(src)[0] for src in comp['sources']]
+        groups = sorted({tuple(d[f] for f in fields) for d in self.docs})
+        if 'after' in comp:
+            groups = [g for g in groups if g > tuple(comp['after'][f] for f in fields)]
+        buckets = []
+        for g in groups[:comp['size']]:
+            docs = [d for d in self.docs if tuple(d[f] for f in fields) == g]
+            buckets += [dict({'key': dict(zip(fields, g)), 'doc_count': len(docs)},
+                             **metrics(docs, aggs['groupby'].get('aggs', {})))]
+        res = {'buckets': buckets}
+        if buckets:
+            res['after_key'] = buckets[-1]['key']
+        return FakeResponse({'hits': {'total': {'value': len(self.docs)}},
+                             'aggregations': {'groupby': res}})
+
+    def open_point_in_time(self, **kwargs):
+        self.calls += [('open_point_in_time', kwargs)]
+        return {'id': 'pit'}
+
+    def close_point_in_time(self, **kwargs):
+        self.calls += [('close_point_in_time', kwargs)]
+
+    def search(self, body=None, **kwargs):
+        self.calls += [('search', dict(kwargs, body=body))]
+        if 'aggs' in body:
+            return self._aggs(body['aggs'])
+        docs = list(enumerate(self.docs))
+        if 'slice' in body:
+            sl = body['slice']
+            docs = [(i, d) for i, d in docs if i % sl['max'] == sl['id']]
+            sid = f"scroll-{sl['id']}"
+            self.scrolls[sid] = (docs, body['size'])
+            return FakeResponse(self._hits(docs, 0, body['size']), _scroll_id=sid)
+        start = body['search_after'][0] + 1 if 'search_after' in body \
+            else body.get('from', 0)
+        return self._hits(docs, start, body.get('size', 10))
+
+    def msearch(self, searches):
+        self.calls += [('msearch', searches)]
+        responses = []
+        for header, body in zip(searches[0::2], searches[1::2]):
+            if header['index'] == 'bad':
+                responses += [{'status': 404, 'error': {'reason': 'no such index [bad]'}}]
+                continue
+            host = body['query']['bool']['filter'][0]['match']['host']
+            docs = [(i, d) for i, d in enumerate(self.docs) if d['host'] == host]
+            responses += [self._hits(docs, body.get('from', 0), body.get('size', 10))]
+        return FakeResponse(responses=responses)
+
+    def scroll(self, scroll_id, **kwargs):
+        docs, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (docs[size:], size)
+        return FakeResponse(self._hits(docs[size:], 0, size), _scroll_id=scroll_id)
+
+    def clear_scroll(self, scroll_id):
+        self.calls += [('clear_scroll', scroll_id)]
+
+
+@pytest.mark.parametrize('n, batch_size, slices, ret', [
+    (0, 10, None, []),
+    (25, 10, None, [10, 10, 5]),
+    (20, 10, None, [10, 10]),
+    (25, 10, 3, [9, 8, 8]),
+])
+def test_iter_read(n, batch_size, slices, ret):
+    dao = ElasticCRUD()
+    dao.set_index('logs-*')
+    dao.client = FakeClient(n)
+    batches = list(dao.iter_read({'host': 'router*'}, batch_size=batch_size,
+                                 slices=slices, metadata=True))
+    assert sorted(d['n'] for b in batches for d in b) == list(range(n))
+    if slices:
+        assert sorted(len(b) for b in batches if b)[::-1] == ret
+        assert len([c for c in dao.client.calls if c[0] == 'clear_scroll']) == slices
+    else:
+        assert [len(b) for b in batches] == ret
+        assert dao.client.calls[0] == ('open_point_in_time',
+                                       {'index': 'logs-*', 'keep_alive': '1m'})
+        assert dao.client.calls[-1][0] == 'close_point_in_time'
+        body = dao.client.calls[1][1]['body']
+        assert body['query']['bool']['filter'][0] == {'wildcard': {'host': 'router*'}}
+    if n:
+        assert batches[0][0]['_meta']['index'] == 'logs'
+    assert dao.index == 'logs-*'
+
+
+def test_iter_read_sort():
+    dao = ElasticCRUD()
+    dao.set_index('logs-*')
+    dao.client = FakeClient(3)
+    batches = list(dao.iter_read(sort={'@timestamp': -1, 'n': 'asc'}))
+    assert sorted(d['n'] for b in batches for d in b) == [0, 1, 2]
+    body = dao.client.calls[1][1]['body']
+    assert body['sort'] == [{'@timestamp': {'order': 'desc'}}, {'n': {'order': 'asc'}}]
+
+
+def test_read_limit_offset():
+    dao = ElasticCRUD()
+    dao.client = FakeClient(10)
+    res = dao.read(index='logs-*', projection={'n': True, 'raw': False},
+                   sort={'n': -1}, limit=2, offset=3, track_total_hits=True)
+    assert res['data'] == [{'n': 3, 'host': 'r0'}, {'n': 4, 'host': 'r1'}]
+    assert res['status']['hits'] == {'value': 10, 'relation': 'eq'}
+    call = dao.client.calls[-1][1]
+    assert call['index'] == ['logs-*']
+    assert (call['body']['size'], call['body']['from']) == (2, 3)
+    assert call['body']['_source'] == {'includes': ['n'], 'excludes': ['raw']}
+    assert call['body']['sort'] == [{'n': {'order': 'desc'}}]
+    assert call['body']['track_total_hits'] is True
+
+
+def test_read_query(monkeypatch):
+    monkeypatch.setattr('common.elastic._clients', {})
+    monkeypatch.setattr('common.elastic.config', {'elastic': {
+        'url': 'localhost', 'username': 'u', 'password': 'p', 'index': 'latest-*'}})
+    dao, dao2 = ElasticCRUD(), ElasticCRUD()
+    assert dao.client is dao2.client
+    dao.client = FakeClient(3)
+    dao.read({'host': 'r1', 'site': ['a', 'b']}, table='logs-*', limit=10)
+    call = dao.client.calls[-1][1]
+    assert call['index'] == ['logs-*'] and dao.index == 'latest-*'
+    filters = call['body']['query']['bool']['filter']
+    assert filters[:2] == [{'match': {'host': 'r1'}}, {'terms': {'site': ['a', 'b']}}]
+    assert list(filters[2]['range']) == ['@timestamp']
+
+
+@pytest.mark.parametrize('kwargs, ret, calls', [
+    ({'agg': {'n': 'sum'}}, [{'count': 10, 'n_sum': 45}], 1),
+    ({'groupby': 'host', 'agg': 'count'},
+     [{'host': 'r0', 'count': 4}, {'host': 'r1', 'count': 3},
+      {'host': 'r2', 'count': 3}], 1),
+    ({'groupby': ['host'], 'agg': {'n': 'sum'}, 'limit': 2},
+     [{'host': 'r0', 'count': 4, 'n_sum': 18}, {'host': 'r1', 'count': 3, 'n_sum': 12}], 1),
+    ({'groupby': 'n', 'limit': 5}, [{'n': i, 'count': 1} for i in range(5)], 1),
+])
+def test_read_agg(kwargs, ret, calls):
+    dao = ElasticCRUD()
+    dao.client = FakeClient(10)
+    res = dao.read(index='logs-*', **kwargs)
+    assert res['data'] == ret
+    assert len(dao.client.calls) == calls
+    assert dao.client.calls[0][1]['body']['size'] == 0
+
+
+def test_read_agg_paging():
+    dao = ElasticCRUD()
+    dao.client = FakeClient(10)
+    r = dao._aggregate(dao._search(), 'logs-*', groupby='n', page_size=4)
+    assert [b['n'] for b in r] == list(range(10))
+    assert len(dao.client.calls) == 3
+    assert dao.client.calls[1][1]['body']['aggs']['groupby']['composite']['after'] == {'n': 3}
+
+
+@pytest.mark.parametrize('kwargs, bad, ret', [
+    ({}, False, (200, 25, 0, [])),
+    ({'chunk_size': 10, 'workers': 3}, False, (200, 25, 0, [])),
+    ({'chunk_size': 10, 'max_retries': 0}, True, (500, 23, 2, ['7', 'x'])),
+])
+def test_bulk(monkeypatch, kwargs, bad, ret):
+    calls, rejected = [], set()
+    lock = threading.Lock()
+
+    def bulk(self, operations=None, **kw):
+        items = []
+        for op in operations[0::2]:
+            _id = json.loads(op)['index']['_id']
+            status = 201
+            with lock:
+                if _id == '7' and _id not in rejected:  # -- rejected once (429)
+                    rejected.add(_id)
+                    status = 429
+                elif _id == 'x':
+                    status = 400
+            items += [{'index': {'_id': _id, 'status': status} if status < 300 else
+                       {'_id': _id, 'status': status, 'error': {'type': 'err'}}}]
+        with lock:
+            calls.append(len(items))
+        return FakeResponse(errors=any(i['index']['status'] >= 300 for i in items),
+                            items=items)
+
+    monkeypatch.setattr(Elasticsearch, 'bulk', bulk)
+    monkeypatch.setattr('elasticsearch.helpers.actions.time.sleep', lambda _: None)
+    dao = ElasticCRUD()
+    dao.client = Elasticsearch('http://localhost:9200')
+    docs = ({'_id': str(i) if i < 24 or not bad else 'x', 'n': i} for i in range(25))
+    st = dao.create(docs, index='logs', **kwargs)['status']
+    assert (st['code'], st['docs'], st['failed']) == ret[:3]
+    assert sorted(e['_id'] for e in st['errors']) == ret[3]
+    assert sum(calls) == 25 + (0 if ret[3] else 1)  # -- w/ retry of the 429
+    if kwargs.get('chunk_size'):
+        assert max(calls) <= kwargs['chunk_size']
+
+
+class FakeAsyncClient:
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            await asyncio.sleep(0)
+            return getattr(self.client, name)(*args, **kwargs)
+        return call
+
+
+def test_async_read():
+    dao = AsyncElasticCRUD()
+    dao.set_index('logs-*')
+    dao.client = FakeClient(25)
+    dao.aclient = FakeAsyncClient(dao.client)
+
+    async def run():
+        batches = [b async for b in dao.iter_read(batch_size=10)]
+        res = await dao.gather({'limit': 2}, {'limit': 3, 'offset': 20},
+                               {'groupby': 'host'}, {})
+        return batches, res
+
+    batches, res = asyncio.run(run())
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert [d['n'] for d in res[0]['data']] == [0, 1]
+    assert [d['n'] for d in res[1]['data']] == [20, 21, 22]
+    assert res[2]['data'] == [{'host': 'r0', 'count': 9}, {'host': 'r1', 'count': 8},
+                              {'host': 'r2', 'count': 8}]
+    assert res[3]['status']['docs'] == 25
+    assert 'index' not in dao.client.calls[1][1]  # -- PIT requests w/o index
+
+
+def test_read_many():
+    dao = ElasticCRUD()
+    dao.set_index('logs-*')
+    dao.client = FakeClient(10)
+    requests = [{'where': {'host': f"r{i % 4}"}, 'limit': 2} for i in range(5)]
+    requests[4]['index'] = 'bad'
+    res = dao.read_many(requests + [{'groupby': 'host'}], chunk_size=2)
+    assert [c[0] for c in dao.client.calls] == ['search'] + ['msearch'] * 3
+    assert [[d['n'] for d in r['data']] for r in res[:4]] == [[0, 3], [1, 4], [2, 5], []]
+    assert res[3]['status']['code'] is None
+    assert res[4]['status'] == {'code': 404, 'message': 'no such index [bad]'}
+    assert res[5]['data'][0] == {'host': 'r0', 'count': 4}
+
+
+def test_async_read_many():
+    dao = AsyncElasticCRUD()
+    dao.set_index('logs-*')
+    dao.client = FakeClient(10)
+    dao.aclient = FakeAsyncClient(dao.client)
+    requests = [{'where': {'host': f"r{i % 4}"}, 'limit': 2} for i in range(3)]
+    res = asyncio.run(dao.read_many(requests + [{'groupby': 'host'}], chunk_size=2))
+    assert all(isinstance(r, dict) for r in res)
+    assert [[d['n'] for d in r['data']] for r in res[:3]] == [[0, 3], [1, 4], [2, 5]]
+    assert res[3]['data'][0] == {'host': 'r0', 'count': 4}
+    assert [c[0] for c in dao.client.calls] == ['search'] + ['msearch'] * 2
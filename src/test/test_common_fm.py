@@ -1,9 +1,18 @@
+import asyncio
+from datetime import timedelta
+import errno
+import json
+import os
+import re
+import shutil
+import time
+
 import pytest
 
-from common.fm import FileManager
-from common.utils import log, wd
+from common.fm import AsyncFileManager, ChecksumIndex, FileManager, FilePipeline
+from common.utils import envar, log, wd
 
-_g = {}
+_g = {'pwd': envar('PWD')}
 
 
 @pytest.fixture
@@ -34,6 +43,24 @@ def remove_everything(fm):
     # fm.reset()
 
 
+def test_async_fm(fm, tmp_path):
+    fm.mkdirs(f"{tmp_path}/input/sub")
+    for fn in ['input/a.txt', 'input/b.txt', 'input/sub/c.txt']:
+        fm.touch(f"{tmp_path}/{fn}")
+
+    async def run():
+        async with AsyncFileManager(fm, workers=2) as afm:
+            names = [x async for x in afm.ls(f"{tmp_path}/input", fn_only=True)]
+            paths = [p async for p, _ in afm.crawl(str(tmp_path), batch=1)]
+            moved = await afm.move('a.txt', f"{tmp_path}/input", str(tmp_path))
+            return names, paths, moved
+
+    names, paths, moved = asyncio.run(run())
+    assert names == ['a.txt', 'b.txt', 'sub']
+    assert f"{tmp_path}/input/sub/c.txt" in paths
+    assert moved and fm.exists(f"{tmp_path}/a.txt")
+
+
 def test_cd(fm):
     # fm.dir_struct(_g['pwd'])
     fm.dir_struct()
@@ -43,6 +70,82 @@ def test_cd(fm):
     assert res.code == 200
 
 
+@pytest.mark.parametrize('chunk_size', [None, 4])
+def test_checksum(fm, tmp_path, chunk_size):
+    with open(f"{tmp_path}/a.txt", 'w') as f:
+        f.write('hello world')
+    res = fm.checksum(f"{tmp_path}/a.txt", chunk_size=chunk_size)
+    assert res == 'b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9'
+    assert fm.checksum(f"{tmp_path}/missing") is None
+
+
+def test_checksum_index(fm, tmp_path):
+    fm.dir_struct(str(tmp_path))
+    for fn, txt in [('a.txt', 'A'), ('b.txt', 'B'), ('a_copy.txt', 'A')]:
+        with open(f"{fm.INPUT}/{fn}", 'w') as f:
+            f.write(txt)
+    index = ChecksumIndex(fm)
+    new, dups = index.check(['a.txt', 'b.txt', 'a_copy.txt'], fm.INPUT)
+    assert (new, dups) == (['a.txt', 'b.txt'], ['a_copy.txt'])
+    assert index.check(['a.txt', 'missing1', 'missing2'], fm.INPUT) == (['a.txt'], [])
+
+    status = FilePipeline(lambda p: True, fm, workers=1, index=index).run(once=True)
+    assert (status.processed, status.skipped) == (2, 1)
+    assert len(ChecksumIndex(fm)) == 2
+
+
+def test_copy(fm, tmp_path):
+    src, dst = f"{tmp_path}/input", f"{tmp_path}/archive"
+    fm.mkdirs(src)
+    fm.mkdirs(dst)
+    with open(f"{src}/data.bin", 'wb') as f:
+        f.write(b'0123456789' * 1000)
+    os.utime(f"{src}/data.bin", (1000000000, 1000000000))
+
+    res = fm.copy('data.bin', src, dst)
+    assert res.code == 200 and res.bytes == 10000
+    assert os.stat(f"{dst}/data.bin").st_mtime == 1000000000
+    assert fm.checksum(f"{dst}/data.bin") == fm.checksum(f"{src}/data.bin")
+
+    # -- resume interrupted copy (same source)
+    with open(f"{dst}/data_1.bin.part", 'wb') as f:
+        f.write(b'0123456789' * 400)
+    with open(f"{dst}/data_1.bin.part.src", 'w') as f:
+        json.dump({'path': f"{src}/data.bin", 'size': 10000,
+                   'mtime_ns': os.stat(f"{src}/data.bin").st_mtime_ns}, f)
+    res = fm.copy('data.bin', src, dst, new_fn='data_1.bin')
+    assert res.bytes == 6000
+    assert not fm.exists(f"{dst}/data_1.bin.part")
+    assert not fm.exists(f"{dst}/data_1.bin.part.src")
+    assert fm.checksum(f"{dst}/data_1.bin") == fm.checksum(f"{src}/data.bin")
+
+    # -- .part of unknown origin is not trusted
+    with open(f"{dst}/data_2.bin.part", 'wb') as f:
+        f.write(b'x' * 9000)
+    res = fm.copy('data.bin', src, dst, new_fn='data_2.bin')
+    assert res.bytes == 10000
+    assert fm.checksum(f"{dst}/data_2.bin") == fm.checksum(f"{src}/data.bin")
+    assert fm.copy('missing', src, dst).code == 404
+
+
+def test_move_cross_device(fm, tmp_path, monkeypatch):
+    src, dst = f"{tmp_path}/input", f"{tmp_path}/archive"
+    fm.mkdirs(src)
+    fm.mkdirs(dst)
+    with open(f"{src}/a.txt", 'w') as f:
+        f.write('new content')
+    with open(f"{dst}/a.txt.part", 'w') as f:
+        f.write('old garbage, longer than the source')
+
+    def rename(_src, _dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'rename', rename)
+    assert fm.move('a.txt', src, dst)
+    with open(f"{dst}/a.txt") as f:
+        assert f.read() == 'new content'
+    assert not fm.exists(f"{src}/a.txt")
+
+
 @pytest.mark.parametrize('path, ff, ret', [
     # ('', '', 200),
     # (None, None, 204),
@@ -132,6 +235,68 @@ def test_exists(fm):
     assert not fm.exists(f"{'pwd'}/fm/testx")
 
 
+def test_file_pipeline(fm, tmp_path):
+    fm.dir_struct(str(tmp_path))
+    fm.mkdirs(f"{fm.INPUT}/.processing")
+    fm.touch(f"{fm.INPUT}/.processing/recovered.txt")
+    for i in range(10):
+        fm.touch(f"{fm.INPUT}/data_{i}.txt")
+
+    def processor(path):
+        if path.endswith('data_3.txt'):
+            raise ValueError('bad file')
+        return not path.endswith('data_4.txt')
+
+    status = FilePipeline(processor, fm, workers=3, max_pending=4).run(once=True)
+    assert status.code == 200
+    assert (status.processed, status.errored) == (9, 2)
+    assert fm.ls(fm.INPUT, fn_only=True) == ['.processing']
+    assert fm.ls(f"{fm.INPUT}/.processing") == []
+    assert fm.ls(fm.ERRORED, fn_only=True) == ['data_3.txt', 'data_4.txt']
+    assert 'recovered.txt' in fm.ls(fm.ARCHIVE, fn_only=True)
+
+
+def test_file_pipeline_index(fm, tmp_path):
+    fm.dir_struct(str(tmp_path))
+    for fn, data in [('a.txt', 'same'), ('b.txt', 'same'), ('c.txt', 'bad')]:
+        with open(f"{fm.INPUT}/{fn}", 'w') as f:
+            f.write(data)
+    seen = []
+
+    def processor(path):
+        seen.append(os.path.basename(path))
+        time.sleep(0.1)  # -- a.txt and b.txt in-flight together
+        return not path.endswith('c.txt')
+
+    index = ChecksumIndex(fm, fn=f"{tmp_path}/.index/test.json")
+    status = FilePipeline(processor, fm, workers=3, index=index,
+                          save_every=0).run(once=True)
+    assert (status.processed, status.errored, status.skipped) == (1, 1, 1)
+    assert sorted(seen) in [['a.txt', 'c.txt'], ['b.txt', 'c.txt']]
+    assert len(index) == 1 and index.digest(f"{fm.ERRORED}/c.txt") not in index
+    assert len(ChecksumIndex(fm, fn=index.fn)) == 1  # -- persisted
+
+
+def test_file_pipeline_move_failed(fm, tmp_path):
+    fm.dir_struct(str(tmp_path))
+    fm.touch(f"{fm.INPUT}/a.txt")
+    index = ChecksumIndex(fm, fn=f"{tmp_path}/.index/test.json")
+
+    def processor(path):
+        shutil.rmtree(fm.ARCHIVE)  # -- destination gone mid-run
+        return True
+
+    status = FilePipeline(processor, fm, index=index).run(once=True)
+    assert (status.processed, status.failed) == (0, 1)
+    assert fm.ls(f"{fm.INPUT}/.processing", fn_only=True) == ['a.txt']
+    assert len(index) == 0
+
+    fm.mkdirs(fm.ARCHIVE)
+    status = FilePipeline(lambda p: True, fm, index=index).run(once=True)
+    assert (status.processed, status.failed) == (1, 0)
+    assert fm.ls(fm.ARCHIVE, fn_only=True) == ['a.txt']
+
+
 @pytest.mark.parametrize('req, ret', [
     (None, None),
     ('', ''),
@@ -154,6 +319,10 @@ def test_exists(fm):
     ('/workspace/python-utils/src/app/../test', '/workspace/python-utils/src/test'),
     ('/workspace/python-utils/src/app/../../.git', '/workspace/python-utils/.git'),
     ('/workspace/python-utils/src/app/../../.git/hooks/../logs', '/workspace/python-utils/.git/logs'),
+    ('./fm/result.txt', '/workspace/python-utils/src/app/fm/result.txt'),
+    ('fm/../input', '/workspace/python-utils/src/app/input'),
+    ('fm/input/./', '/workspace/python-utils/src/app/fm/input/'),
+    ('/workspace/file..txt', '/workspace/file..txt'),
 ])
 def test_fullpath(fm, req, ret):
     mockdata = '/workspace/python-utils/src/app'
@@ -162,6 +331,27 @@ def test_fullpath(fm, req, ret):
     assert res == ret
 
 
+@pytest.mark.parametrize('kwargs, ret', [
+    ({}, ['a.csv', 'b.txt', 'sub/c.csv', 'sub/leaf/d.csv', 'skip/e.csv']),
+    ({'glob': '*.csv'}, ['a.csv', 'sub/c.csv', 'sub/leaf/d.csv', 'skip/e.csv']),
+    ({'fn_pattern': r'^[ab]\.'}, ['a.csv', 'b.txt']),
+    ({'max_depth': 1}, ['a.csv', 'b.txt', 'sub/c.csv', 'skip/e.csv']),
+    ({'exclude': ['skip']}, ['a.csv', 'b.txt', 'sub/c.csv', 'sub/leaf/d.csv']),
+])
+def test_iter_tree(fm, tmp_path, kwargs, ret):
+    fm.mkdirs(f"{tmp_path}/sub/leaf")
+    fm.mkdirs(f"{tmp_path}/skip")
+    for fn in ['a.csv', 'b.txt', 'sub/c.csv', 'sub/leaf/d.csv', 'skip/e.csv']:
+        fm.touch(f"{tmp_path}/{fn}")
+    res = [p[len(str(tmp_path))+1:] for p, _ in fm.iter_tree(str(tmp_path), **kwargs)]
+    assert sorted(res) == sorted(ret)
+
+    res, status = fm.crawl_dir(str(tmp_path))
+    assert status.code == 200
+    assert f"{tmp_path}/a.csv" in res and f"{tmp_path}/sub/leaf/d.csv" in res
+    assert f"{tmp_path}/sub/leaf/" in res
+
+
 def test_latest(fm):
     fm.dir_struct(_g['pwd'])
 
@@ -172,6 +362,17 @@ def test_latest(fm):
     assert  res == 'result.4'
 
 
+def test_latest_oldest_fn_pattern(fm, tmp_path):
+    # -- created in reverse name order, 1s apart (ctime has a 1s resolution)
+    for fn in ['data.3', 'other.0', 'data.2', 'data.1']:
+        fm.touch(f"{tmp_path}/{fn}")
+        time.sleep(1.05)
+    assert fm.latest(str(tmp_path), fn_pattern=r'^data\.', fn_only=True) == 'data.1'
+    assert fm.oldest(str(tmp_path), fn_pattern=r'^data\.', fn_only=True) == 'data.3'
+    assert fm.oldest(str(tmp_path), fn_only=True) == 'data.3'
+    assert fm.ls(str(tmp_path), fn_pattern=r'^data\.', ret='dict')[0]['filename'] == 'data.1'
+
+
 def test_list(fm):
     fm.dir_struct(_g['pwd'])
 
@@ -193,6 +394,29 @@ def test_ls_list(req):
     remove_everything(_g['pwd'])
 
 
+def test_ls_table(fm, tmp_path):
+    for i, fn in enumerate(['c.log', 'a.log', 'b.txt']):
+        with open(f"{tmp_path}/{fn}", 'w') as f:
+            f.write('x' * (i+1) * 10)
+        os.utime(f"{tmp_path}/{fn}", (1000000000 + i, 1000000000 + i))
+
+    res = fm.ls(str(tmp_path), ret='table')
+    assert len(res) == 3
+    assert [x['filename'] for x in res.sort('filename')] == ['a.log', 'b.txt', 'c.log']
+    assert res.sort('mtime', reverse=True)[0]['filename'] == 'b.txt'
+    old = res.filter(older_than=timedelta(days=1), min_size=20)
+    assert sorted(old.name) == ['a.log', 'b.txt']
+    assert old.filter(fn_pattern=r'\.log$').to_dict()[0]['size'] == 20
+    assert len(res.filter(newer_than=60)) == 0
+    assert len(res.to_list()) == 3
+
+    latest = fm.latest(str(tmp_path), fn_pattern=r'\.log$', ret='table')
+    oldest = fm.oldest(str(tmp_path), fn_pattern=r'\.log$', ret='table')
+    assert (len(latest), len(oldest)) == (1, 1)
+    assert latest.name == [fm.latest(str(tmp_path), fn_pattern=r'\.log$', fn_only=True)]
+    assert oldest.name == [fm.oldest(str(tmp_path), fn_pattern=r'\.log$', fn_only=True)]
+
+
 @pytest.mark.parametrize('req', [
     ('dict'),
     ('json')
@@ -234,6 +458,25 @@ def test_move(fm):
     assert 'result.3' in files_list
 
 
+def test_move_many(fm, tmp_path):
+    src, dst = f"{tmp_path}/input", f"{tmp_path}/archive"
+    fm.mkdirs(src)
+    fm.mkdirs(dst)
+    for fn in ['result.1', 'result.2', 'data.csv']:
+        fm.touch(f"{src}/{fn}")
+    fm.touch(f"{dst}/data.csv")
+    fm.touch(f"{dst}/data_1.csv")
+
+    res, status = fm.move_many(['result.1', 'result.2', 'data.csv', 'missing'], src, dst)
+    assert status.code == 500
+    assert res['result.1'].code == 200
+    assert res['data.csv'].message == f"{dst}/data_2.csv"
+    assert res['missing'].code == 404
+    assert fm.ls(src, fn_only=True) == []
+    assert sorted(fm.ls(dst, fn_only=True)) == \
+        ['data.csv', 'data_1.csv', 'data_2.csv', 'result.1', 'result.2']
+
+
 def test_oldest(fm):
     fm.dir_struct(_g['pwd'])
 
@@ -252,6 +495,121 @@ def test_retention(fm):
     assert files_list == ['result.3', 'result.4']
 
 
+@pytest.mark.parametrize('kwargs, ret', [
+    ({'keep_last': 2}, ['archive/result.1', 'input/result.1']),
+    ({'max_bytes': 12}, ['archive/result.1', 'input/result.1', 'input/result.2']),
+    ({'max_age': timedelta(days=1)}, []),
+    ({'keep_last': 1, 'fn_pattern': r'\.3$'}, []),
+])
+def test_retention_tree(fm, tmp_path, kwargs, ret):
+    for d, size in [('archive', 5), ('input', 10)]:
+        fm.mkdirs(f"{tmp_path}/{d}")
+        for fn in ['result.1', 'result.2', 'result.3']:
+            with open(f"{tmp_path}/{d}/{fn}", 'w') as f:
+                f.write('x' * size)
+
+    res, status = fm.retention(str(tmp_path), dry_run=True, **kwargs)
+    assert sorted(res['files']) == [f"{tmp_path}/{x}" for x in ret]
+    assert len(os.listdir(f"{tmp_path}/input")) == 3
+
+    res, status = fm.retention(str(tmp_path), **kwargs)
+    assert status.code == (200 if ret else 204)
+    assert res['count'] == len(ret)
+    for x in ret:
+        assert not fm.exists(f"{tmp_path}/{x}")
+
+
+def test_retention_hidden_dirs(fm, tmp_path):
+    for d in ['input/.processing', '.index', 'input']:
+        fm.mkdirs(f"{tmp_path}/{d}")
+        fm.touch(f"{tmp_path}/{d}/data.1")
+    res, _ = fm.retention(str(tmp_path), max_age=0, dry_run=True)
+    assert res['files'] == [f"{tmp_path}/input/data.1"]
+    res, _ = fm.retention(str(tmp_path), max_age=0, dry_run=True, exclude=None)
+    assert res['count'] == 3
+
+
+@pytest.mark.parametrize('shard, depth', [
+    ('hash', 2),
+    ('date', 3),
+])
+def test_sharded_bucket(tmp_path, shard, depth):
+    fm = FileManager()
+    fm.dir_struct(str(tmp_path))
+    fm.set_bucket('b1', shard=shard)
+    for fn in ['result.1', 'result.2', 'result.3']:
+        fm.touch(f"{fm.INPUT}/{fn}")
+        assert fm.ls(fm.INPUT, fn_only=True) == [fn]
+        assert fm.move(fn, fm.INPUT, fm.ARCHIVE)
+
+    assert fm.ls(fm.ARCHIVE, fn_only=True) == ['result.1', 'result.2', 'result.3']
+    assert fm.latest(fm.ARCHIVE, fn_only=True) == 'result.3'
+    assert fm.oldest(fm.ARCHIVE, fn_only=True) == 'result.1'
+    assert fm.exists(f"{fm.shard_dir(fm.ARCHIVE, 'result.2')}/result.2")
+    assert fm.shard_dir(fm.ARCHIVE, 'x').count('/') == fm.ARCHIVE.count('/') + depth
+
+    assert fm.move('result.2', fm.ARCHIVE, fm.ERRORED)
+    assert fm.ls(fm.ERRORED, fn_only=True) == ['result.2']
+    assert fm.ls(fm.ARCHIVE, fn_only=True) == ['result.1', 'result.3']
+
+    # -- name conflict: renamed file is sharded on its new name
+    for _ in range(2):
+        fm.touch(f"{fm.INPUT}/x.txt")
+        assert fm.move('x.txt', fm.INPUT, fm.ARCHIVE)
+    assert fm.move('x_1.txt', fm.ARCHIVE, fm.ERRORED)
+    assert fm.ls(fm.ERRORED, fn_only=True) == ['result.2', 'x_1.txt']
+
+
+@pytest.mark.parametrize('shard', ['hash', 'date'])
+def test_sharded_move_many_pipeline(tmp_path, shard):
+    fm = FileManager()
+    fm.dir_struct(str(tmp_path))
+    fm.set_bucket('b1', shard=shard)
+    fm.mkdirs(f"{tmp_path}/drop")
+    for fn in ['a.txt', 'b.txt', 'c.txt']:
+        fm.touch(f"{tmp_path}/drop/{fn}")
+    res, status = fm.move_many(['a.txt', 'b.txt', 'c.txt'], f"{tmp_path}/drop", fm.INPUT)
+    assert status.code == 200
+    assert res['a.txt'].message == f"{fm.shard_dir(fm.INPUT, 'a.txt')}/a.txt"
+    assert fm.ls(fm.INPUT, fn_only=True) == ['a.txt', 'b.txt', 'c.txt']
+
+    status = FilePipeline(lambda p: True, fm, workers=2).run(once=True)
+    assert status.processed == 3
+    assert fm.ls(fm.ARCHIVE, fn_only=True) == ['a.txt', 'b.txt', 'c.txt']
+    res, status = fm.move_many(['a.txt', 'b.txt'], fm.ARCHIVE, fm.ERRORED)
+    assert status.code == 200
+    assert fm.ls(fm.ERRORED, fn_only=True) == ['a.txt', 'b.txt']
+
+
+@pytest.mark.parametrize('shard', ['hash', 'date'])
+def test_sharded_retention(tmp_path, shard):
+    fm = FileManager()
+    fm.dir_struct(str(tmp_path))
+    fm.set_bucket('b1', shard=shard)
+    files = [f"log_{i}.txt" for i in range(5)]
+
+    def archive():
+        for fn in files:
+            fm.touch(f"{fm.INPUT}/{fn}")
+            assert fm.move(fn, fm.INPUT, fm.ARCHIVE)
+        assert fm.ls(fm.ARCHIVE, fn_only=True) == files
+
+    archive()
+    r, status = fm.retention(fm.ARCHIVE, keep_last=2)
+    assert (status.code, r['count']) == (200, 3)
+    assert len(fm.ls(fm.ARCHIVE, fn_only=True)) == 2
+
+    fm.del_files(fm.ARCHIVE, fn_pattern='log_')
+    archive()
+    fm.retainer(fm.ARCHIVE, 'log_', 2)
+    assert len(fm.ls(fm.ARCHIVE, fn_only=True)) == 2
+
+    r, status = fm.retention(str(tmp_path), keep_last=1)
+    assert len(fm.ls(fm.ARCHIVE, fn_only=True)) == 1
+    assert fm.del_files(fm.ARCHIVE, fm.ls(fm.ARCHIVE, fn_only=True))
+    assert fm.ls(fm.ARCHIVE, fn_only=True) == []
+
+
 def test_touch(fm):
     fm.dir_struct(_g['pwd'])
 
@@ -263,3 +621,28 @@ def test_touch(fm):
     fm.touch(f"{_g['pwd']}/fm/test1/result.4")
     files_list = [x[1] for x in fm.ls(f"{_g['pwd']}/fm/test1")]
     assert files_list == ['result.1', 'result.2', 'result.3', 'result.4']
+
+
+@pytest.mark.skipif(not os.environ.get('FM_BENCH'), reason='manual-run (FM_BENCH=1)')
+@pytest.mark.parametrize('n', [100_000])
+def test_ts_sorted_file_bench(fm, tmp_path, n):
+    def baseline(req, directory, fn_pattern):
+        # -- previous implementation: stat() per entry, full sort, then filter
+        f_list = sorted([[int(os.stat(os.path.join(directory, f.name)).st_ctime), f.name] \
+                         for f in os.scandir(directory)])
+        t = [n for n in f_list if re.search(fn_pattern, n[1])]
+        return t[-1] if req == 'latest' else t[0] if req == 'oldest' else t
+
+    for i in range(n):
+        open(f"{tmp_path}/file_{i:06d}.dat", 'w').close()
+    for req in ['list', 'latest', 'oldest']:
+        st = time.perf_counter()
+        r = fm._ts_sorted_file(req, str(tmp_path), fn_pattern=r'file_0[0-4]')
+        new = time.perf_counter() - st
+        st = time.perf_counter()
+        b = baseline(req, str(tmp_path), r'file_0[0-4]')
+        old = time.perf_counter() - st
+        log.info(f"bench: _ts_sorted_file({req}) on {n} files: {new:.3f}s "
+                 f"(previous: {old:.3f}s)")
+        assert r == b
+        assert new < old
@@ -118,6 +118,17 @@ def test_delete():
     assert dao.delete({'_id': 'randollrr'})
 
 
+def test_upsert_and_delete_many():
+    docs = [{'sku': 'a1', 'qty': 1}, {'sku': 'b2', 'qty': 2}]
+    assert dao.upsert(docs, key='sku', collection='test_upsert')['status']['code'] == 200
+    docs[0]['qty'] = 10
+    res = dao.upsert(docs, key='sku', collection='test_upsert')
+    assert res['data'][0]['upserted'] == 0
+    assert dao.read1({'sku': 'a1'}, 'test_upsert')['qty'] == 10
+    res = dao.delete_many({}, collection='test_upsert')
+    assert res['data'][0]['delete_count'] == 2
+
+
 # @pytest.fixture
 # def test_teardown(dbms):
 def test_teardown_test():
@@ -0,0 +1,274 @@
+from datetime import datetime
+import importlib
+import os
+import shutil
+import sys
+import types
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+rows = [
+    ['Name', 'Start Date', 'Amount', 'Notes'],
+    ['randoll', '01/15/2024', 10, None],
+    ['msmith', 'Feb 03, 2024 PST', 20.5, 'ok'],
+    [None, None, None, None],
+    ['jdoe', 'not a date', None, 'late'],
+]
+
+
+@pytest.fixture
+def px(monkeypatch):
+    # -- common.mongo connects on import: stub it (for these tests only) so
+    #    common.parse_xlsx imports offline
+    if 'common.mongo' not in sys.modules:
+        monkeypatch.setitem(sys.modules, 'common.mongo', types.SimpleNamespace(dao=None))
+    return importlib.import_module('common.parse_xlsx')
+
+
+@pytest.fixture
+def xlsx(tmp_path):
+    fn = f"{tmp_path}/vendor.xlsx"
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'data'
+    for r in rows:
+        ws.append(r)
+    ws2 = wb.create_sheet('other')
+    ws2.append(['k', 'v'])
+    ws2.append(['a', 1])
+    wb.save(fn)
+    return fn
+
+
+@pytest.mark.parametrize('batch_size, ret', [
+    (1, [1, 1, 1]),
+    (2, [2, 1]),
+    (1000, [3]),
+])
+def test_iter_sheet(px, xlsx, batch_size, ret):
+    xdc = px.XlsxDataCollector(xlsx, transformer={'Name': 'name', 'Amount': 'amount'},
+                            auto_parse=False)
+    batches = list(xdc.iter_sheet(batch_size=batch_size))
+    assert [len(b) for b in batches] == ret
+    assert batches[0][0] == {'name': 'randoll', 'amount': 10}
+    assert batches[-1][-1] == {'name': 'jdoe', 'amount': ''}
+
+    xdc = px.XlsxDataCollector(xlsx, auto_parse=False)
+    assert list(xdc.iter_sheet('other')) == [[{'k': 'a', 'v': 1}]]
+
+
+def test_read_sheet_transformer(px, xlsx):
+    xdc = px.XlsxDataCollector(xlsx, sheetname='data', transformer={
+        'Name': 'name',
+        'Start Date': {'name': 'start_dt', 'type': 'date'},
+        'Amount': {'name': 'amount', 'type': 'float', 'default': 0},
+        'total': {'compute': lambda df: df['amount'] * 2},
+    })
+    assert xdc.data == [
+        {'name': 'randoll', 'start_dt': '2024-01-15', 'amount': 10.0, 'total': 20.0},
+        {'name': 'msmith', 'start_dt': '2024-02-03', 'amount': 20.5, 'total': 41.0},
+        {'name': '', 'start_dt': '', 'amount': 0, 'total': 0},
+        {'name': 'jdoe', 'start_dt': 'not a date', 'amount': 0, 'total': 0},
+    ]
+
+
+def test_transform_missing_typed(px, xlsx):
+    xdc = px.XlsxDataCollector(xlsx, sheetname='data', transformer={
+        'Name': 'name',
+        'Start Date': {'name': 'start_dt', 'type': 'datetime', 'format': '%m/%d/%Y'},
+        'Amount': {'name': 'amount', 'type': 'int'},
+    })
+    assert [r['amount'] for r in xdc.data] == [10, 20, '', '']
+    assert [r['start_dt'] for r in xdc.data] == [datetime(2024, 1, 15), '', '', '']
+    assert all(isinstance(r['amount'], int) for r in xdc.data[:2])
+
+    batches = list(xdc.iter_sheet(batch_size=2))
+    assert [r['amount'] for b in batches for r in b] == [10, 20, '']
+
+
+def test_transform_bool(px, xlsx):
+    xdc = px.XlsxDataCollector(xlsx, auto_parse=False,
+                               transformer={'ok': {'type': 'bool'}})
+    df = pd.DataFrame({'ok': [True, 'False', 'no', ' Yes ', '0', 1, 0.0, 'maybe', None]})
+    assert xdc.transform(df)['ok'].tolist() == \
+        [True, False, False, True, False, True, False, '', '']
+
+
+@pytest.mark.parametrize('i, o', [
+    ('01/15/2024', '2024-01-15'),
+    ('Feb 03, 2024 PST', '2024-02-03'),
+    ('n/a', 'n/a'),
+    (None, None),
+])
+def test_to_date(px, xlsx, i, o):
+    xdc = px.XlsxDataCollector(xlsx, auto_parse=False)
+    assert xdc.to_date(i) == o
+    assert xdc.to_date(i) == o  # -- memoized
+
+
+@pytest.mark.parametrize('i, o', [
+    (['01/15/2024', 'Feb 03, 2024 PDT', None, 'n/a'], ['2024-01-15', '2024-02-03', '', 'n/a']),
+    ([datetime(2024, 3, 1), '12/31/2023'], ['2024-03-01', '2023-12-31']),
+])
+def test_to_dates(px, xlsx, i, o):
+    xdc = px.XlsxDataCollector(xlsx, auto_parse=False)
+    res = xdc.to_dates(pd.Series(i, name='dt')).fillna('').tolist()
+    assert res == o
+    assert xdc.date_stats['dt']['unparsed'] == o.count('n/a')
+
+
+def test_batch_collector(px, xlsx, tmp_path):
+    os.makedirs(f"{tmp_path}/input")
+    os.makedirs(f"{tmp_path}/errored")
+    shutil.copy(xlsx, f"{tmp_path}/input/a.xlsx")
+    shutil.copy(xlsx, f"{tmp_path}/input/b.xlsx")
+    with open(f"{tmp_path}/input/bad.xlsx", 'w') as f:
+        f.write('not a workbook')
+
+    bc = px.XlsxBatchCollector(f"{tmp_path}/input", sheets=['data', 'other'],
+                            errored=f"{tmp_path}/errored", workers=2)
+    status = bc.run()
+    assert (status.files, status.sheets, status.records) == (2, 4, 10)
+    assert status.errored == [f"{tmp_path}/input/bad.xlsx"]
+    assert os.listdir(f"{tmp_path}/errored") == ['bad.xlsx']
+    assert bc.data[f"{tmp_path}/input/a.xlsx"]['other'] == [{'k': 'a', 'v': 1}]
+
+
+def test_batch_collector_errored_default(px, tmp_path, monkeypatch):
+    os.makedirs(f"{tmp_path}/input")
+    os.makedirs(f"{tmp_path}/errored")
+    with open(f"{tmp_path}/input/bad.xlsx", 'w') as f:
+        f.write('not a workbook')
+    monkeypatch.setattr('common.parse_xlsx.fm.ERRORED', f"{tmp_path}/errored")
+
+    status = px.XlsxBatchCollector(f"{tmp_path}/input", workers=1).run()
+    assert status.errored == [f"{tmp_path}/input/bad.xlsx"]
+    assert os.listdir(f"{tmp_path}/errored") == ['bad.xlsx']
+
+
+def test_batch_collector_sink_failed(px, xlsx, tmp_path, monkeypatch):
+    os.makedirs(f"{tmp_path}/input")
+    os.makedirs(f"{tmp_path}/errored")
+    shutil.copy(xlsx, f"{tmp_path}/input/a.xlsx")
+    with open(f"{tmp_path}/input/bad.xlsx", 'w') as f:
+        f.write('not a workbook')
+
+    def sink(filename, sheetname, records):
+        raise IOError('sink down')
+
+    monkeypatch.chdir(f"{tmp_path}/input")  # -- relative paths
+    status = px.XlsxBatchCollector(['a.xlsx', 'bad.xlsx'], sink=sink,
+                                   errored=f"{tmp_path}/errored", workers=1).run()
+    assert (status.files, status.errored, status.failed) == (0, ['bad.xlsx'], ['a.xlsx'])
+    assert os.listdir(f"{tmp_path}/input") == ['a.xlsx']
+    assert os.listdir(f"{tmp_path}/errored") == ['bad.xlsx']
+
+
+def test_batch_collector_unpicklable(px, xlsx, tmp_path):
+    os.makedirs(f"{tmp_path}/input")
+    os.makedirs(f"{tmp_path}/errored")
+    shutil.copy(xlsx, f"{tmp_path}/input/a.xlsx")
+
+    bc = px.XlsxBatchCollector(f"{tmp_path}/input", errored=f"{tmp_path}/errored",
+                            transformer={'total': {'compute': lambda df: 0}})
+    status = bc.run()
+    assert status.code == 400
+    assert (status.files, status.errored) == (0, [])
+    assert os.listdir(f"{tmp_path}/input") == ['a.xlsx']
+    assert os.listdir(f"{tmp_path}/errored") == []
+
+
+class FakeDao:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls += [(name, args, kwargs)]
+            return {'status': {'code': 200, 'message': 'OK'}, 'data': []}
+        return call
+
+
+@pytest.mark.parametrize('kwargs, ret', [
+    ({}, ['create', 'create', 'create']),
+    ({'truncate': True}, ['delete_many', 'create', 'create', 'create']),
+    ({'truncate': 'swap'}, ['delete_many', 'create', 'create', 'create', 'rename']),
+    ({'key': 'id'}, ['upsert', 'upsert', 'upsert']),
+])
+def test_save_to_db(px, xlsx, monkeypatch, kwargs, ret):
+    dao = FakeDao()
+    monkeypatch.setattr('common.parse_xlsx.dao', dao)
+    xdc = px.XlsxDataCollector(xlsx, auto_parse=False)
+    data = ([{'id': i} for i in range(j, j+2)] for j in range(0, 6, 2))
+
+    res = xdc.save_to_db(data, collection='vendor', batch_size=2, **kwargs)
+    assert res['status']['code'] == 200 and res['status']['docs'] == 6
+    assert [c[0] for c in dao.calls] == ret
+    if kwargs.get('truncate') == 'swap':
+        assert dao.calls[1][1][1] == 'vendor_staging'
+        assert dao.calls[-1][1] == ('vendor',)
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv', 'parquet', 'arrow'])
+def test_to_file(px, xlsx, tmp_path, fmt):
+    if fmt in ['parquet', 'arrow']:
+        pytest.importorskip('pyarrow')
+    xdc = px.XlsxDataCollector(xlsx, transformer={'Name': 'name', 'Amount': 'amount',
+                                               'Notes': 'notes'}, auto_parse=False)
+    fn = f"{tmp_path}/vendor.{fmt}"
+    status = xdc.to_file(fn, data=xdc.iter_sheet(batch_size=1), batch_size=2)
+    assert status.code == 200 and status.records == 3
+    assert not os.path.exists(f"{fn}.part")
+
+    if fmt == 'ndjson':
+        df = pd.read_json(fn, lines=True)
+    elif fmt == 'csv':
+        df = pd.read_csv(fn)
+    elif fmt == 'parquet':
+        df = pd.read_parquet(fn)
+    else:
+        df = pd.read_feather(fn)
+    assert df['name'].tolist() == ['randoll', 'msmith', 'jdoe']
+    assert df['amount'].replace('', None).fillna(0).tolist() == [10, 20.5, 0]
+    assert xdc.to_file(f"{tmp_path}/vendor.txt").code == 400
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'arrow'])
+def test_to_file_widen(px, xlsx, tmp_path, fmt):
+    pytest.importorskip('pyarrow')
+    xdc = px.XlsxDataCollector(xlsx, auto_parse=False)
+    data = [{'amount': 1, 'code': 7}, {'amount': 2, 'code': 8},
+            {'amount': 2.5, 'code': 9}, {'amount': None, 'code': 'x1'}]
+    fn = f"{tmp_path}/mixed.{fmt}"
+    status = xdc.to_file(fn, data=data, batch_size=2)
+    assert status.code == 200 and status.records == 4
+
+    df = pd.read_parquet(fn) if fmt == 'parquet' else pd.read_feather(fn)
+    assert df['amount'].fillna(0).tolist() == [1.0, 2.0, 2.5, 0]
+    assert df['code'].tolist() == ['7', '8', '9', 'x1']
+
+
+def test_parse_cache(px, xlsx, tmp_path, monkeypatch):
+    cache = f"{tmp_path}/cache"
+    transformer = {'Name': 'name', 'Amount': {'name': 'amount', 'default': 0}}
+    xdc = px.XlsxDataCollector(xlsx, transformer=transformer, cache=cache)
+    assert len(os.listdir(cache)) == 1
+
+    # -- hit: workbook isn't opened
+    monkeypatch.setattr(pd, 'read_excel', lambda *a, **kw: 1/0)
+    xdc2 = px.XlsxDataCollector(xlsx, transformer=transformer, cache=cache)
+    assert xdc2.data == xdc.data and xdc2.xls_file is None
+    monkeypatch.undo()
+
+    # -- new key: sheet, transformer, sort_by or content changed
+    px.XlsxDataCollector(xlsx, sheetname='other', cache=cache)
+    px.XlsxDataCollector(xlsx, transformer={'Name': 'name'}, cache=cache)
+    px.XlsxDataCollector(xlsx, transformer=transformer, cache=cache,
+                      auto_parse=False).read_sheet(sort_by='Name')
+    assert len(os.listdir(cache)) == 4
+    with open(xlsx, 'ab') as f:
+        f.write(b'\0')
+    px.XlsxDataCollector(xlsx, transformer=transformer, cache=cache)
+    assert len(os.listdir(cache)) == 5